@@ -1,89 +1,185 @@
+import asyncio
+import base64
+import binascii
 import datetime
+import functools
+import hashlib
+import json
 import logging
 import os
 import random
 import re
+import time
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
+from anyio import from_thread, to_thread
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from fastapi import FastAPI, HTTPException, Depends, Query
-from pydantic import BaseModel, validator
-from sqlalchemy import create_engine
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+import orjson
+import pydantic_core
+from pydantic import BaseModel, TypeAdapter, ValidationError, validator
+from sqlalchemy import delete, func, literal_column, select, text
 from sqlalchemy.orm import Session
 
-from generate_users import generate_test_users, generate_user_data, create_user_in_db
-from models import SessionLocal, User, Address, CreditCard
+from cache import LRUCache
+from generate_users import (
+    generate_test_users, generate_user_data, bulk_insert_users, drop_duplicate_emails
+)
+from database import SessionLocal, engine
+from events import EventBroadcaster, Subscription
+from metrics import (
+    JOB_DURATION, JOB_USERS, METRICS_CONTENT_TYPE, MetricsMiddleware, instrument_engine, register_broadcaster,
+    register_cache, render_metrics
+)
+from models import (
+    User, Address, CreditCard, UserChange, UserStats, INLINE_STORAGE, NESTED_FIELDS, USER_STATS_ID,
+    compact_user_changes, init_db, reset_user_changes, users_fts
+)
+from snapshots import restore_snapshot, save_snapshot
+from user_import import ImportFormatError, ImportRow, parse_csv, parse_ndjson
+from workers import WORKER_LOCK_PREFIX, WorkerLocks
+from virtual_users import (
+    VIRTUAL_BACKEND, delete_virtual_users, find_virtual_emails, init_virtual_users, live_virtual_ids,
+    materialize_virtual_user, serialize_virtual_user, virtual_created_at, virtual_ids_after
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
 
-DATABASE_URL = "sqlite:///./users.db"
-
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False
-)
-
-scheduler = AsyncIOScheduler()
-
-
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 1000))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 1000))
+# SQLite integers are signed 64-bit, larger ids can't even be bound to a query
+MAX_SQLITE_INTEGER = 2 ** 63 - 1
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+# POST /v1/users/import: users committed per transaction, the longest line read and the failed rows
+# listed in the report (all of them are counted)
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 1000))
+IMPORT_MAX_LINE_BYTES = int(os.getenv('IMPORT_MAX_LINE_BYTES', 1024 * 1024))
+IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', 1000))
+FTS_MIN_TERM_LENGTH = 3
+# Encode users read back from the database straight to JSON, skipping UserResponse validation
+TRUSTED_SERIALIZATION = os.getenv('TRUSTED_SERIALIZATION', 'true').lower() == 'true'
+# orjson writes floats from this magnitude on as 1e16 where pydantic writes 1e+16
+ORJSON_MAX_EXACT_FLOAT = 1e16
+
+THREADPOOL_SIZE = int(os.getenv('THREADPOOL_SIZE', 40))
+
+USERS_NUMBER = int(os.getenv('USERS_NUMBER', 1000))
+USERS_SEED = int(os.getenv('USERS_SEED')) if os.getenv('USERS_SEED') else None
+# GET /v1/users/events: events queued per subscriber before it is dropped as too slow, the
+# subscriber limit and the interval of keep-alive comments on idle streams
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 100))
+MAX_EVENT_SUBSCRIBERS = int(os.getenv('MAX_EVENT_SUBSCRIBERS', 10000))
+EVENT_KEEPALIVE_SECONDS = float(os.getenv('EVENT_KEEPALIVE_SECONDS', 15))
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+# How often followers check whether the leader is gone, and workers apply each other's writes to their user cache
+LEADER_RETRY_SECONDS = float(os.getenv('LEADER_RETRY_SECONDS', 5))
+USER_CACHE_SYNC_SECONDS = float(os.getenv('USER_CACHE_SYNC_SECONDS', 1))
+# GET /v1/users/changes can resume from any change made within this period
+USER_CHANGES_RETENTION_HOURS = int(os.getenv('USER_CHANGES_RETENTION_HOURS', 24))
+
+# GET /v1/users/{user_id} responses (ETag, serialized UserResponse) by user id, invalidated by every write path
+user_cache = LRUCache(int(os.getenv('USER_CACHE_SIZE', 10000)))
+register_cache("user", user_cache)
+broadcaster = EventBroadcaster(MAX_EVENT_SUBSCRIBERS, EVENT_QUEUE_SIZE)
+register_broadcaster(broadcaster)
+instrument_engine(engine)
+
+# Sync jobs run in this executor's threads rather than on the event loop
+scheduler = AsyncIOScheduler(executors={'default': ThreadPoolExecutor(max_workers=1)})
+worker_locks = WorkerLocks(WORKER_LOCK_PREFIX)
+
+
+@JOB_DURATION.labels("initialize_users").time()
 def initialize_users():
     """Initialize users only if database is empty"""
     db = SessionLocal()
     try:
-        user_count = db.query(User).count()
+        user_count = get_user_stats(db).total_users
         if user_count == 0:
             logger.info("Database is empty, generating initial test users...")
-            users_num = int(os.getenv('USERS_NUMBER', 1000))
-            generate_test_users(users_num)
-            logger.info(f"Successfully initialized {os.getenv('USERS_NUMBER', users_num)} test users")
+            workers = os.getenv('GENERATOR_WORKERS')
+            created_count = generate_test_users(
+                USERS_NUMBER,
+                seed=USERS_SEED,
+                workers=int(workers) if workers else None
+            )
+            JOB_USERS.labels("initialize_users", "created").inc(created_count)
+            reset_user_changes()
+            logger.info(f"Successfully initialized {created_count} test users")
         else:
             logger.info(f"Database already contains {user_count} users, skipping initialization")
     finally:
         db.close()
 
 
-def scheduled_user_management():
-    """Scheduled job to add and remove users"""
+def initialize_virtual_users():
     db = SessionLocal()
     try:
-        users_to_add = random.randint(1, 7)
-        added_count = 0
+        init_virtual_users(db)
+        db.commit()
+    finally:
+        db.close()
 
-        for _ in range(users_to_add):
-            user_data = generate_user_data()
-            user_id = create_user_in_db(db, user_data)
-            if user_id:
-                added_count += 1
 
-        users_to_delete = random.randint(1, 3)
-        oldest_users = db.query(User).order_by(User.created_at.asc()).limit(users_to_delete).all()
+@JOB_DURATION.labels("scheduled_user_management").time()
+def scheduled_user_management():
+    """
+    Scheduled job to add and remove users.
 
-        deleted_count = 0
-        for user in oldest_users:
-            try:
-                db.query(Address).filter(Address.user_id == user.id).delete()
-                db.query(CreditCard).filter(CreditCard.user_id == user.id).delete()
-
-                db.delete(user)
-                deleted_count += 1
-            except Exception as e:
-                logger.error(f"Error deleting user {user.id}: {str(e)}")
-                db.rollback()
-                continue
+    New users are generated before touching the database. The job then runs as a handful
+    of set-based statements in one short write transaction: a bulk insert and three
+    DELETE ... WHERE user_id IN (...) for the oldest users (found through the created_at index).
+    """
+    users_data = [generate_user_data() for _ in range(random.randint(1, 7))]
+    users_to_delete = random.randint(1, 3)
 
+    db = SessionLocal()
+    try:
+        users_data, _ = drop_duplicate_emails(db, users_data)
+        if VIRTUAL_BACKEND:
+            taken = registered_emails(db, [user_data["email"] for user_data in users_data])
+            users_data = [user_data for user_data in users_data if user_data["email"] not in taken]
+        # Virtual users are older than any user created through the API
+        deleted_ids = virtual_ids_after(db, 0, users_to_delete) if VIRTUAL_BACKEND else []
+        if not deleted_ids:
+            deleted_ids = db.scalars(
+                select(User.id).order_by(User.created_at.asc(), User.id.asc()).limit(users_to_delete)
+            ).all()
+
+        created_ids = bulk_insert_users(db, users_data)
+        if VIRTUAL_BACKEND:
+            delete_virtual_users(db, deleted_ids)
+        if not INLINE_STORAGE:
+            db.execute(delete(Address).where(Address.user_id.in_(deleted_ids)))
+            db.execute(delete(CreditCard).where(CreditCard.user_id.in_(deleted_ids)))
+        db.execute(delete(User).where(User.id.in_(deleted_ids)))
         db.commit()
 
-        # Get current user count
-        total_users = db.query(User).count()
-
-        logger.info(
-            f"Scheduled job completed: Added {added_count} users, deleted {deleted_count} users. Total users: {total_users}")
+        user_cache.invalidate(*deleted_ids)
+        if broadcaster.active:
+            for user in get_users_by_ids(db, created_ids):
+                publish_user_event("created", user)
+            for user_id in deleted_ids:
+                publish_user_event("deleted", {"id": user_id})
+        added_count = len(users_data)
+        deleted_count = len(deleted_ids)
+        JOB_USERS.labels("scheduled_user_management", "created").inc(added_count)
+        JOB_USERS.labels("scheduled_user_management", "deleted").inc(deleted_count)
+
+        total_users = get_user_stats(db).total_users
+        logger.info(f"Scheduled job completed: Added {added_count} users, deleted {deleted_count} users. "
+                    f"Total users: {total_users}")
 
     except Exception as e:
         logger.error(f"Error in scheduled user management: {str(e)}")
@@ -92,12 +188,46 @@ def scheduled_user_management():
         db.close()
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Manage application lifespan"""
-    logger.info("Starting UserService API...")
-    initialize_users()
+@JOB_DURATION.labels("compact_user_changes").time()
+def scheduled_change_compaction():
+    """Scheduled job to delete the changes older than USER_CHANGES_RETENTION_HOURS"""
+    try:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=USER_CHANGES_RETENTION_HOURS)
+        deleted_count = compact_user_changes(cutoff)
+        logger.info(f"Change log compacted: deleted {deleted_count} changes made before {cutoff}")
+    except Exception as e:
+        logger.error(f"Error in change log compaction: {str(e)}")
+
+
+def initialize_database():
+    """Recreate the database with the seeded users"""
+    if VIRTUAL_BACKEND:
+        # Users are generated on demand, the database only holds changes
+        init_db()
+        initialize_virtual_users()
+    # A snapshot of the seeded dataset is restored as is, otherwise it is generated (and snapshotted)
+    elif not restore_snapshot(USERS_NUMBER, USERS_SEED):
+        init_db()
+        initialize_users()
+        save_snapshot(USERS_NUMBER, USERS_SEED)
 
+
+def start_worker() -> bool:
+    """
+    Initialize the database if this is the first worker of the deployment, return whether
+    this worker is the leader. Workers start one at a time, so the others wait for the
+    database to be ready and never recreate it under a running worker.
+    """
+    with worker_locks.startup():
+        if worker_locks.join():
+            initialize_database()
+        else:
+            logger.info(f"Worker {os.getpid()} joined running workers, the database is already initialized")
+        return worker_locks.try_lead()
+
+
+def start_jobs():
+    """Schedule the jobs, in the leader only"""
     scheduler.add_job(
         scheduled_user_management,
         trigger=IntervalTrigger(minutes=5),
@@ -105,13 +235,84 @@ async def lifespan(app: FastAPI):
         name='Add and remove users every 5 minutes',
         replace_existing=True
     )
+    scheduler.add_job(
+        scheduled_change_compaction,
+        trigger=IntervalTrigger(hours=1),
+        id='change_compaction',
+        name='Delete expired user changes every hour',
+        replace_existing=True
+    )
     scheduler.start()
     logger.info("Scheduler started - user management job will run every 5 minutes")
 
+
+async def follow_leader():
+    """Take over the jobs once the leader is gone"""
+    while not worker_locks.try_lead():
+        await asyncio.sleep(LEADER_RETRY_SECONDS)
+    start_jobs()
+
+
+def sync_user_cache(last_seq: Optional[int]) -> int:
+    """
+    Invalidate the users changed since change `last_seq` (by any worker) in this worker's
+    cache, return the seq of the last change applied. Without `last_seq` only the seq is read.
+    """
+    db = SessionLocal()
+    try:
+        compacted_seq, current_seq = get_change_log_bounds(db)
+        if last_seq is None or current_seq == last_seq:
+            return current_seq
+        if not compacted_seq <= last_seq < current_seq:
+            # The changes in between are gone, forget everything
+            user_cache.clear()
+        else:
+            user_cache.invalidate(*db.scalars(
+                select(UserChange.user_id).where(UserChange.seq > last_seq, UserChange.seq <= current_seq).distinct()
+            ))
+        return current_seq
+    finally:
+        db.close()
+
+
+async def keep_user_cache_in_sync():
+    """
+    Apply the writes of the other workers to the user cache every USER_CACHE_SYNC_SECONDS.
+    A worker invalidates its own writes right away.
+    """
+    last_seq = await run_in_threadpool(sync_user_cache, None)
+    while True:
+        await asyncio.sleep(USER_CACHE_SYNC_SECONDS)
+        try:
+            last_seq = await run_in_threadpool(sync_user_cache, last_seq)
+        except Exception as e:
+            logger.error(f"Error syncing the user cache: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Manage application lifespan"""
+    logger.info("Starting UserService API...")
+    # Route handlers are sync and run in the worker thread pool, so database I/O never blocks the event loop
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    background_tasks = []
+    if await run_in_threadpool(start_worker):
+        start_jobs()
+    else:
+        logger.info(f"Worker {os.getpid()} is a follower, the leader runs the scheduled jobs")
+        background_tasks.append(asyncio.create_task(follow_leader()))
+    background_tasks.append(asyncio.create_task(keep_user_cache_in_sync()))
+    broadcaster.start(asyncio.get_running_loop())
+
     yield
 
     logger.info("Shutting down UserService API...")
-    scheduler.shutdown()
+    broadcaster.stop()
+    for task in background_tasks:
+        task.cancel()
+    if scheduler.running:
+        scheduler.shutdown()
+    worker_locks.close()
 
 
 class AddressModel(BaseModel):
@@ -151,7 +352,7 @@ class UserCreate(BaseModel):
     surname: str
     email: str
     phone: Optional[str] = None
-    date_of_birth: Optional[str] = None
+    date_of_birth: Optional[datetime.date] = None
     address: Optional[AddressModel] = None
     gender: Optional[str] = None
     company: Optional[str] = None
@@ -165,7 +366,7 @@ class UserUpdate(BaseModel):
     surname: Optional[str] = None
     email: Optional[str] = None
     phone: Optional[str] = None
-    date_of_birth: Optional[str] = None
+    date_of_birth: Optional[datetime.date] = None
     address: Optional[AddressModel] = None
     gender: Optional[str] = None
     company: Optional[str] = None
@@ -179,7 +380,7 @@ class UserResponse(BaseModel):
     surname: str
     email: str
     phone: Optional[str]
-    date_of_birth: Optional[str]
+    date_of_birth: Optional[datetime.date]
     address: Optional[AddressModel]
     gender: Optional[str]
     company: Optional[str]
@@ -192,11 +393,84 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 
+class UserStatsResponse(BaseModel):
+    total_users: int
+    users_with_address: int
+    users_with_credit_card: int
+
+    class Config:
+        from_attributes = True
+
+
+class UserChangeResponse(BaseModel):
+    seq: int
+    user_id: int
+    operation: str
+    changed_at: datetime.datetime
+    # Current data of a created or updated user, None for a deleted one
+    user: Optional[UserResponse] = None
+
+
+class UserChangesResponse(BaseModel):
+    changes: List[UserChangeResponse]
+    next_since: int
+
+
+user_list_adapter = TypeAdapter(List[UserResponse])
+
+# Fields that can be requested with `fields`, in response order
+USER_RESPONSE_FIELDS = tuple(UserResponse.model_fields)
+
+
+class BatchCreateResult(BaseModel):
+    index: int
+    status_code: int
+    user: Optional[UserResponse] = None
+    error: Optional[str] = None
+
+
+class BatchCreateResponse(BaseModel):
+    created: int
+    failed: int
+    results: List[BatchCreateResult]
+
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportResponse(BaseModel):
+    rows: int
+    created: int
+    failed: int
+    # The first IMPORT_MAX_ERRORS failed rows, in order
+    errors: List[ImportRowError]
+    seconds: float
+    rows_per_second: float
+
+
 app = FastAPI(
     title="UserService API",
     version="1.0.0",
     lifespan=lifespan
 )
+app.add_middleware(MetricsMiddleware)
+
+
+def get_user_stats(db: Session) -> UserStats:
+    """The trigger-maintained user counters (a primary key lookup, never a scan)"""
+    stats = db.get(UserStats, USER_STATS_ID, populate_existing=True)
+    if not VIRTUAL_BACKEND:
+        return stats
+
+    # Stored users are counted by the triggers, unstored virtual users always have an address and a card
+    virtual_count = stats.unstored_virtual_users
+    return UserStats(
+        total_users=stats.total_users + virtual_count,
+        users_with_address=stats.users_with_address + virtual_count,
+        users_with_credit_card=stats.users_with_credit_card + virtual_count
+    )
 
 
 def get_db():
@@ -207,123 +481,761 @@ def get_db():
         db.close()
 
 
-def get_user_with_details(db: Session, user_id: int):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        return None
-
-    user = {
+def serialize_user(user: User, address: Optional[Address] = None, credit_card: Optional[CreditCard] = None):
+    user_details = {
         "id": user.id,
         "name": user.name,
         "surname": user.surname,
         "email": user.email,
         "phone": user.phone,
         "date_of_birth": user.date_of_birth,
+        "address": None,        # Always include, default to None
         "gender": user.gender,
         "company": user.company,
         "salary": user.salary,
         "about_me": user.about_me,
-        "created_at": user.created_at,
-        "address": None,        # Always include, default to None
         "credit_card": None,    # Always include, default to None
+        "created_at": user.created_at,
     }
 
-    address = db.query(Address).filter(Address.user_id == user_id).first()
     if address:
-        user["address"] = {
+        user_details["address"] = {
             "country": address.country,
             "city": address.city,
             "street": address.street,
             "flat_house": address.flat_house
         }
-    credit_card = db.query(CreditCard).filter(CreditCard.user_id == user_id).first()
     if credit_card:
-        user["credit_card"] = {
+        user_details["credit_card"] = {
             "num": credit_card.num,
             "cvv": credit_card.cvv,
             "exp_date": credit_card.exp_date
         }
 
-    return user
+    return user_details
+
+
+def serialize_inline_user(user: User):
+    """`serialize_user` for USER_STORAGE=inline, where the address and credit card are columns of `user`"""
+    user_details = serialize_user(user)
+    for field, (_, columns) in NESTED_FIELDS.items():
+        if getattr(user, f"{field}_{columns[0]}") is not None:
+            user_details[field] = {column: getattr(user, f"{field}_{column}") for column in columns}
+    return user_details
+
+
+def set_inline_details(db_user: User, field: str, details: BaseModel):
+    """Store an AddressModel or CreditCardModel in the inline columns of `field` (USER_STORAGE=inline)"""
+    for column, value in details.model_dump().items():
+        setattr(db_user, f"{field}_{column}", value)
+
+
+def is_trusted_encodable(users: List[dict]) -> bool:
+    """Users (or projections without `salary`) that orjson encodes exactly like pydantic"""
+    return TRUSTED_SERIALIZATION and all(
+        user.get("salary") is None or abs(user["salary"]) < ORJSON_MAX_EXACT_FLOAT for user in users
+    )
+
+
+def encode_user(user: dict, fields: Optional[List[str]] = None) -> bytes:
+    """
+    JSON of a user built by `serialize_user`, byte for byte what UserResponse would produce.
+
+    The dict already has the UserResponse field order and types, so in trusted mode it is
+    encoded directly instead of being validated again (card number, CVV and expiry regexes).
+    Projections (`fields`) have no model to validate against: otherwise they are encoded by
+    pydantic's serializer without validation, so a field is written the same with or without `fields`.
+    """
+    if is_trusted_encodable([user]):
+        return orjson.dumps(user)
+    if fields is not None:
+        return pydantic_core.to_json(user)
+    return UserResponse.model_validate(user).model_dump_json().encode()
+
+
+def encode_users(users: List[dict], fields: Optional[List[str]] = None) -> bytes:
+    """JSON list of users built by `serialize_user`, see `encode_user`"""
+    if is_trusted_encodable(users):
+        return orjson.dumps(users)
+    if fields is not None:
+        return pydantic_core.to_json(users)
+    return user_list_adapter.dump_json(user_list_adapter.validate_python(users))
+
+
+def users_response(users: List[dict], response: Response, fields: Optional[List[str]] = None) -> Response:
+    """JSON response of `users`, carrying the headers already set on `response`"""
+    return Response(
+        content=encode_users(users, fields), media_type="application/json", headers=dict(response.headers)
+    )
+
+
+def get_users_with_details(db: Session, query, order_by=(), fields: Optional[List[str]] = None):
+    """
+    Resolve users selected by `query` together with their address and credit card.
+
+    Addresses and credit cards are outer-joined onto the user query, so the whole
+    result is loaded with a single statement no matter how many users match.
+    With USER_STORAGE=inline they are part of the user rows and nothing is joined.
+    Users are ordered by `order_by` first (if given) and by id.
+    With `fields` only those fields are loaded, see `get_projected_users`.
+    """
+    if fields is not None:
+        return get_projected_users(query, fields, order_by)
+    if INLINE_STORAGE:
+        return [serialize_inline_user(user) for user in query.order_by(*order_by, User.id).all()]
+
+    rows = (
+        query
+        .outerjoin(Address, Address.user_id == User.id)
+        .outerjoin(CreditCard, CreditCard.user_id == User.id)
+        .add_entity(Address)
+        .add_entity(CreditCard)
+        .order_by(*order_by, User.id, Address.id, CreditCard.id)
+        .all()
+    )
+
+    result = []
+    last_user_id = None
+    for user, address, credit_card in rows:
+        # Only the first address and card of a user are exposed, extra join rows are skipped
+        if user.id == last_user_id:
+            continue
+        last_user_id = user.id
+        result.append(serialize_user(user, address, credit_card))
+
+    return result
+
+
+def encode_cursor(user_id: int) -> str:
+    payload = json.dumps({"id": user_id}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        user_id = int(json.loads(payload)["id"])
+    except (binascii.Error, ValueError, KeyError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if abs(user_id) > MAX_SQLITE_INTEGER:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return user_id
+
+
+def get_projected_users(query, fields: List[str], order_by=()):
+    """
+    Resolve only `fields` (as returned by `parse_fields`) of the users selected by `query`.
+
+    Only the matching columns are selected, and addresses or credit cards are joined in
+    only when `address` or `credit_card` is requested (with USER_STORAGE=inline their
+    columns are selected from the user rows instead).
+    """
+    query = query.with_entities(*(getattr(User, field) for field in fields if field not in NESTED_FIELDS))
+    order = [*order_by, User.id]
+    for field, (model, columns) in NESTED_FIELDS.items():
+        if field not in fields:
+            continue
+        if INLINE_STORAGE:
+            query = query.add_columns(*(getattr(User, f"{field}_{column}") for column in columns))
+            continue
+        query = query.outerjoin(model, model.user_id == User.id).add_columns(
+            *(getattr(model, column).label(f"{field}_{column}") for column in columns)
+        )
+        order.append(model.id)
+
+    result = []
+    last_user_id = None
+    for row in query.order_by(*order).all():
+        values = row._mapping
+        # Only the first address and card of a user are exposed, extra join rows are skipped
+        if values["id"] == last_user_id:
+            continue
+        last_user_id = values["id"]
+
+        user = {}
+        for field in fields:
+            if field not in NESTED_FIELDS:
+                user[field] = values[field]
+            elif values[f"{field}_{NESTED_FIELDS[field][1][0]}"] is None:
+                user[field] = None
+            else:
+                user[field] = {column: values[f"{field}_{column}"] for column in NESTED_FIELDS[field][1]}
+        result.append(user)
+
+    return result
+
+
+def get_users_after(db: Session, query, after_id: int, limit: int, fields: Optional[List[str]] = None,
+                    id_column=User.id):
+    """
+    Resolve at most `limit` users of `query` with an id greater than `after_id`, ordered by id.
+
+    `id_column` is the id expression the page is cut and ordered by, see FILTER_INDEX_ID.
+    """
+    page_ids = (
+        query
+        .with_entities(User.id)
+        .filter(id_column > after_id)
+        .order_by(id_column)
+        .limit(limit)
+        .subquery()
+    )
+    return get_users_with_details(db, db.query(User).filter(User.id.in_(select(page_ids.c.id))), fields=fields)
+
+
+def stream_users_ndjson(after_id: int = 0, fields: Optional[List[str]] = None):
+    """
+    Yield every user with an id greater than `after_id` as one JSON line.
+
+    The table is walked in keyset chunks of STREAM_CHUNK_SIZE users with a session of its
+    own, so memory stays bounded by the chunk size however large the table is.
+    """
+    db = SessionLocal()
+    try:
+        while True:
+            if VIRTUAL_BACKEND:
+                users = get_virtual_users_after(db, None, after_id, STREAM_CHUNK_SIZE, fields)
+            else:
+                users = get_users_after(db, db.query(User), after_id, STREAM_CHUNK_SIZE, fields)
+            if not users:
+                break
+
+            for user in users:
+                yield encode_user(user, fields) + b"\n"
+
+            after_id = users[-1]["id"]
+            db.expunge_all()
+    finally:
+        db.close()
+
+
+def get_users_page(db: Session, query, request: Request, response: Response, cursor: Optional[str],
+                   limit: Optional[int], order_by=(), fields: Optional[List[str]] = None, id_column=User.id):
+    """
+    Keyset pagination over `users.id`.
+
+    Without `cursor` and `limit` the whole result is returned, as before, ordered by
+    `order_by` (if given) and id. Otherwise only users with an id greater than the one
+    encoded in the cursor are read, so every page costs the same. The cursor of the next
+    page is returned in `X-Next-Cursor` and `Link`. Pages are read through `id_column`,
+    see `get_users_after`.
+    """
+    if cursor is None and limit is None:
+        return get_users_with_details(db, query, order_by, fields)
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    after_id = decode_cursor(cursor) if cursor is not None else 0
+
+    # One extra row tells whether there is a next page
+    result = get_users_after(db, query, after_id, limit + 1, fields, id_column)
+    return set_next_page(request, response, result, limit)
+
+
+def set_next_page(request: Request, response: Response, result: List[dict], limit: int) -> List[dict]:
+    """Cut `result` (read with one extra user) to `limit` users and link the next page, if there is one"""
+    if len(result) > limit:
+        result = result[:limit]
+        next_cursor = encode_cursor(result[-1]["id"])
+        next_url = request.url.include_query_params(cursor=next_cursor, limit=limit)
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+
+    return result
+
+
+def get_virtual_users(db: Session, user_ids: List[int], fields: Optional[List[str]] = None) -> List[dict]:
+    """
+    The users with `user_ids` with the virtual backend, ordered by id (unknown ids are skipped).
+
+    Stored users (created, or virtual ones that were updated) come from the database, the
+    others are generated.
+    """
+    users = {
+        user["id"]: user
+        for user in get_users_with_details(db, db.query(User).filter(User.id.in_(user_ids)), fields=fields)
+    }
+    for user_id in live_virtual_ids(db, [user_id for user_id in user_ids if user_id not in users]):
+        user = serialize_virtual_user(user_id)
+        users[user_id] = user if fields is None else {field: user[field] for field in fields}
+    return [users[user_id] for user_id in sorted(users)]
+
+
+def get_virtual_users_after(db: Session, user_ids: Optional[List[int]], after_id: int, limit: Optional[int],
+                            fields: Optional[List[str]] = None) -> List[dict]:
+    """
+    `get_users_after` of the virtual backend: at most `limit` users with an id greater than
+    `after_id`, out of `user_ids` if given (then None is no limit), ordered by id.
+    """
+    if user_ids is not None:
+        return get_virtual_users(db, sorted({user_id for user_id in user_ids if user_id > after_id}), fields)[:limit]
+
+    stored_ids = db.scalars(select(User.id).where(User.id > after_id).order_by(User.id).limit(limit)).all()
+    page_ids = sorted(set(stored_ids).union(virtual_ids_after(db, after_id, limit)))[:limit]
+    return get_virtual_users(db, page_ids, fields)
+
+
+def get_virtual_users_page(db: Session, user_ids: Optional[List[int]], request: Request, response: Response,
+                           cursor: Optional[str], limit: Optional[int], fields: Optional[List[str]] = None):
+    """
+    `get_users_page` of the virtual backend. Without `cursor` and `limit` only the listed
+    `user_ids` are returned whole: a list of every virtual user would take time and memory in
+    proportion to USERS_NUMBER, so it starts with a page of DEFAULT_PAGE_SIZE users instead.
+    """
+    if user_ids is not None and cursor is None and limit is None:
+        return get_virtual_users_after(db, user_ids, 0, None, fields)
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    after_id = decode_cursor(cursor) if cursor is not None else 0
+    result = get_virtual_users_after(db, user_ids, after_id, limit + 1, fields)
+    return set_next_page(request, response, result, limit)
+
+
+def apply_text_search(query, terms: dict):
+    """
+    Filter `query` by partial, case-insensitive matches of `terms` (column name -> value).
+
+    Terms of FTS_MIN_TERM_LENGTH+ characters are matched through the users_fts trigram
+    index, shorter ones (which trigrams can't match) fall back to ILIKE. Returns the
+    filtered query and whether it is joined to users_fts, i.e. can be ordered by rank.
+    """
+    match_terms = []
+    for column_name, value in terms.items():
+        if not value:
+            continue
+        if len(value) >= FTS_MIN_TERM_LENGTH:
+            phrase = value.replace('"', '""')
+            match_terms.append(f'{column_name} : "{phrase}"')
+        else:
+            query = query.filter(getattr(User, column_name).ilike(f"%{value}%"))
+
+    if not match_terms:
+        return query, False
+
+    query = (
+        query
+        .join(users_fts, users_fts.c.rowid == User.id)
+        .filter(literal_column("users_fts").op("MATCH")(" AND ".join(match_terms)))
+    )
+    return query, True
+
+
+# users.id behind a unary +, which SQLite can't look up or order through the primary key. Ordered by
+# users.id, a query whose only filters are ranges walks the whole table in id order to skip the sort,
+# where ordered by this it searches the index of a filter and sorts the matches.
+FILTER_INDEX_ID = literal_column("+users.id")
+
+
+def apply_structured_filters(query, gender: Optional[str] = None, date_of_birth: Optional[datetime.date] = None,
+                             date_of_birth_from: Optional[datetime.date] = None,
+                             date_of_birth_to: Optional[datetime.date] = None, salary_min: Optional[float] = None,
+                             salary_max: Optional[float] = None, company: Optional[str] = None):
+    """
+    Filter `query` by exact gender, company and date of birth and by date of birth and salary
+    ranges (None is no filter). Returns the filtered query and whether any filter was applied.
+
+    Dates of birth are stored as ISO dates, which sort like the dates. Every filter leads one of
+    the users indexes (see models.User); a filtered query must be ordered and paginated by
+    FILTER_INDEX_ID for SQLite to search one of them rather than scan the table by id.
+    """
+    conditions = []
+    if gender is not None:
+        conditions.append(User.gender == gender)
+    if company is not None:
+        conditions.append(User.company == company)
+    if date_of_birth is not None:
+        conditions.append(User.date_of_birth == date_of_birth)
+    if date_of_birth_from is not None:
+        conditions.append(User.date_of_birth >= date_of_birth_from)
+    if date_of_birth_to is not None:
+        conditions.append(User.date_of_birth <= date_of_birth_to)
+    if salary_min is not None:
+        conditions.append(User.salary >= salary_min)
+    if salary_max is not None:
+        conditions.append(User.salary <= salary_max)
+    return query.filter(*conditions), bool(conditions)
+
+
+def user_etag(user_id: int, updated_at: datetime.datetime, fields: Optional[List[str]] = None) -> str:
+    if fields is None:
+        return f'"{user_id}-{updated_at:%Y%m%d%H%M%S%f}"'
+    # A projection is a different representation, so it gets an ETag of its own
+    fields_digest = hashlib.sha1(",".join(fields).encode()).hexdigest()[:12]
+    return f'"{user_id}-{updated_at:%Y%m%d%H%M%S%f}-{fields_digest}"'
+
+
+def users_table_etag(db: Session, request: Request) -> str:
+    """
+    ETag of a list response: a digest of the users table version and the query string.
+
+    Any insert or update moves max(updated_at) and any delete changes the user count, so the
+    version changes whenever a list response could. Both are index/primary key lookups.
+    """
+    last_updated_at = select(func.max(User.updated_at)).scalar_subquery()
+    # Deleting an unstored virtual user only adds a tombstone, which changes unstored_virtual_users
+    user_count, last_updated_at = db.query(
+        UserStats.total_users + UserStats.unstored_virtual_users, last_updated_at
+    ).filter(UserStats.id == USER_STATS_ID).one()
+    digest = hashlib.sha1(f"{user_count}:{last_updated_at}:{request.url.query}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+def check_users_etag(db: Session, request: Request, response: Response) -> Optional[Response]:
+    """Set the list ETag on `response`, return a 304 response if the client already has that version"""
+    etag = users_table_etag(db, request)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+
+def parse_ids(ids: str) -> List[int]:
+    try:
+        user_ids = [int(user_id) for user_id in ids.split(",") if user_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    if any(abs(user_id) > MAX_SQLITE_INTEGER for user_id in user_ids):
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    if len(user_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"No more than {MAX_BATCH_SIZE} ids can be requested at once")
+    return user_ids
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Requested fields in response order (`id` is always included), None for all of them"""
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested.difference(USER_RESPONSE_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    requested.add("id")
+    return [field for field in USER_RESPONSE_FIELDS if field in requested]
+
+
+def registered_emails(db: Session, emails: List[str]) -> set:
+    """The emails of `emails` that belong to a user, stored or (with the virtual backend) generated"""
+    registered = set(db.scalars(select(User.email).where(User.email.in_(emails))))
+    if VIRTUAL_BACKEND:
+        registered.update(find_virtual_emails(db, emails))
+    return registered
+
+
+def get_users_by_ids(db: Session, user_ids: List[int]) -> List[dict]:
+    """The users with `user_ids`, ordered by id (unknown ids are skipped)"""
+    if VIRTUAL_BACKEND:
+        return get_virtual_users(db, user_ids)
+    return get_users_with_details(db, db.query(User).filter(User.id.in_(user_ids)))
+
+
+def get_change_log_bounds(db: Session) -> tuple:
+    """(seq before the oldest retained change, seq of the last change)"""
+    last_seq = db.scalar(text("SELECT seq FROM sqlite_sequence WHERE name = 'user_changes'")) or 0
+    oldest_seq = db.scalar(select(func.min(UserChange.seq)))
+    return (oldest_seq - 1 if oldest_seq is not None else last_seq), last_seq
+
+
+def publish_user_event(event: str, user: dict):
+    """Push a committed write to GET /v1/users/events: the user when created or updated, its id when deleted"""
+    if broadcaster.active:
+        data = encode_user(user) if event != "deleted" else encode_user(user, fields=["id"])
+        broadcaster.publish(b"event: " + event.encode() + b"\ndata: " + data + b"\n\n")
+
+
+async def stream_user_events(subscription: Subscription):
+    """Server-Sent Events of `subscription` until the client disconnects or is dropped"""
+    try:
+        # Sent at once, so the client sees the stream open before the first event
+        yield b": subscribed\n\n"
+        while True:
+            try:
+                async with asyncio.timeout(EVENT_KEEPALIVE_SECONDS):
+                    message = await subscription.queue.get()
+            except TimeoutError:
+                # Keeps proxies from timing out idle streams, and finds clients that went away
+                yield b": keep-alive\n\n"
+                continue
+            if message is None:
+                if subscription.dropped:
+                    yield b"event: dropped\ndata: {}\n\n"
+                return
+            yield message
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+def get_user_with_details(db: Session, user_id: int, fields: Optional[List[str]] = None):
+    if VIRTUAL_BACKEND:
+        users = get_virtual_users(db, [user_id], fields)
+    else:
+        users = get_users_with_details(db, db.query(User).filter(User.id == user_id), fields=fields)
+    return users[0] if users else None
 
 
 @app.get("/v1/users/search", response_model=List[UserResponse])
-async def search_users(
+def search_users(
+        request: Request,
+        response: Response,
         name: Optional[str] = Query(None, description="Search by name (partial match)"),
         surname: Optional[str] = Query(None, description="Search by surname (partial match)"),
         email: Optional[str] = Query(None, description="Search by email (partial match)"),
+        gender: Optional[str] = Query(None, description="Search by gender (exact match)"),
+        date_of_birth: Optional[datetime.date] = Query(None, description="Search by date of birth (YYYY-MM-DD)"),
+        date_of_birth_from: Optional[datetime.date] = Query(None, description="Born on or after this date"),
+        date_of_birth_to: Optional[datetime.date] = Query(None, description="Born on or before this date"),
+        salary_min: Optional[float] = Query(None, description="Salary of at least this much"),
+        salary_max: Optional[float] = Query(None, description="Salary of at most this much"),
+        company: Optional[str] = Query(None, description="Search by company (exact match)"),
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+        cursor: Optional[str] = Query(None, description="Cursor of the page to return (from X-Next-Cursor)"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return (default: all)"),
         db: Session = Depends(get_db)
 ):
     """
     Search users by various criteria.
 
     All text fields (name, surname, email) support partial matching (case-insensitive).
-    Gender must be an exact match.
-    Date of birth can be searched by exact date or date range.
+    Terms of 3+ characters are looked up in the trigram full-text index and unpaginated
+    results are ordered by relevance.
+    Gender and company must be exact matches.
+    Date of birth can be searched by exact date or date range, salary by range (bounds included).
+    Each of these filters is backed by an index, see `apply_structured_filters`.
+
+    Results are paginated when `limit` or `cursor` is passed.
+    With `fields` only the listed fields (and `id`) are returned.
+    Not available with the virtual backend, whose users aren't indexed.
     """
-    logger.info(f"Search users request - name: {name}, surname: {surname}, email: {email}")
+    structured_filters = {
+        "gender": gender,
+        "date_of_birth": date_of_birth,
+        "date_of_birth_from": date_of_birth_from,
+        "date_of_birth_to": date_of_birth_to,
+        "salary_min": salary_min,
+        "salary_max": salary_max,
+        "company": company,
+    }
+    logger.info(f"Search users request - name: {name}, surname: {surname}, email: {email}, "
+                f"filters: { {key: value for key, value in structured_filters.items() if value is not None} }, "
+                f"fields: {fields}")
+    fields = parse_fields(fields)
+    if VIRTUAL_BACKEND:
+        raise HTTPException(status_code=501, detail="Search is not available with the virtual user backend")
 
-    query = db.query(User)
+    not_modified = check_users_etag(db, request, response)
+    if not_modified:
+        logger.info("Search users completed - not modified")
+        return not_modified
 
-    if name:
-        query = query.filter(User.name.ilike(f"%{name}%"))
+    query, filtered = apply_structured_filters(db.query(User), **structured_filters)
+    query, ranked = apply_text_search(query, {"name": name, "surname": surname, "email": email})
+    id_column = FILTER_INDEX_ID if filtered else User.id
+    order_by = (users_fts.c.rank,) if ranked else (FILTER_INDEX_ID,) if filtered else ()
 
-    if surname:
-        query = query.filter(User.surname.ilike(f"%{surname}%"))
+    result = get_users_page(db, query, request, response, cursor, limit, order_by, fields, id_column)
 
-    if email:
-        query = query.filter(User.email.ilike(f"%{email}%"))
+    logger.info(f"Search users completed - found {len(result)} users matching criteria")
+    return users_response(result, response, fields)
 
-    users = query.all()
 
-    result = []
-    for user in users:
-        user_details = get_user_with_details(db, user.id)
-        if user_details:
-            result.append(user_details)
+@app.get("/v1/users/stats", response_model=UserStatsResponse)
+def get_users_stats(db: Session = Depends(get_db)):
+    """Get the number of users, users with an address and users with a credit card"""
+    stats = get_user_stats(db)
+    logger.info(f"Get users stats completed - total users: {stats.total_users}")
+    return stats
 
-    logger.info(f"Search users completed - found {len(result)} users matching criteria")
-    return result
 
+@app.get("/v1/users/events", response_class=StreamingResponse)
+async def get_user_events():
+    """
+    Stream user writes as Server-Sent Events: `created` and `updated` with the user, `deleted` with its id.
+
+    Each subscriber has a bounded queue; one that falls behind gets a `dropped` event and its
+    stream ends, and should catch up through GET /v1/users/changes before subscribing again.
+    """
+    subscription = broadcaster.subscribe()
+    if subscription is None:
+        logger.warning(f"Get user events failed - {MAX_EVENT_SUBSCRIBERS} subscribers already")
+        raise HTTPException(status_code=503, detail="Too many event subscribers")
+    logger.info(f"Get user events - subscribers: {broadcaster.stats()['subscribers']}")
+    return StreamingResponse(
+        stream_user_events(subscription),
+        media_type=EVENT_STREAM_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-@app.get("/v1/users", response_model=List[UserResponse])
-async def get_all_users(db: Session = Depends(get_db)):
-    """Get all users"""
-    logger.info("Get all users request")
 
-    users = db.query(User).all()
+@app.get("/v1/users/changes", response_model=UserChangesResponse)
+def get_user_changes(
+        since: Optional[int] = Query(None, ge=0, description="Sequence number the client is synced up to"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of users"),
+        db: Session = Depends(get_db)
+):
+    """
+    Get the users changed after change `since`, once each with their last change, in change order.
+
+    Created and updated users come with their current data, so a client applies the entries as
+    upserts and deletes and passes `next_since` as `since` on the next call. Without `since` only
+    the current sequence number is returned: take it before a full GET /v1/users to sync from it.
+    When changes after `since` were already compacted away the answer is 410 and the client resyncs.
+    """
+    logger.info(f"Get user changes request - since: {since}, limit: {limit}")
+    # The bounds, the changes and the users are separate reads (SELECTs don't hold a snapshot), so writes
+    # committed in between can already show up: clients apply entries as upserts, so that's harmless
+    compacted_seq, last_seq = get_change_log_bounds(db)
+    if since is None:
+        return {"changes": [], "next_since": last_seq}
+    if since < compacted_seq or since > last_seq:
+        logger.warning(f"Get user changes failed - since {since} is outside the change log "
+                       f"({compacted_seq} - {last_seq})")
+        raise HTTPException(status_code=410, detail="Changes after `since` are not available, resync all users")
+
+    latest = (
+        select(func.max(UserChange.seq).label("seq"))
+        .where(UserChange.seq > since)
+        .group_by(UserChange.user_id)
+        .order_by(func.max(UserChange.seq))
+        .limit(limit)
+        .subquery()
+    )
+    changes = db.scalars(
+        select(UserChange).join(latest, UserChange.seq == latest.c.seq).order_by(UserChange.seq)
+    ).all()
+    changed_ids = [change.user_id for change in changes if change.operation != "delete"]
+    users = {user["id"]: user for user in get_users_by_ids(db, changed_ids)} if changed_ids else {}
+
     result = []
+    for change in changes:
+        user = users.get(change.user_id)
+        result.append({
+            "seq": change.seq,
+            "user_id": change.user_id,
+            "operation": change.operation if user is not None else "delete",
+            "changed_at": change.changed_at,
+            "user": user,
+        })
+    # Past every returned change, including ones committed after last_seq was read
+    next_since = changes[-1].seq if len(changes) == limit else max(last_seq, changes[-1].seq if changes else 0)
+    logger.info(f"Get user changes completed - returned {len(result)} changes, next since: {next_since}")
+    return {"changes": result, "next_since": next_since}
+
+
+@app.get("/v1/users", response_model=List[UserResponse])
+def get_all_users(
+        request: Request,
+        response: Response,
+        ids: Optional[str] = Query(None, description="Only return users with these comma-separated ids"),
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+        cursor: Optional[str] = Query(None, description="Cursor of the page to return (from X-Next-Cursor)"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return (default: all)"),
+        db: Session = Depends(get_db)
+):
+    """
+    Get all users, paginated when `limit` or `cursor` is passed.
+
+    With `ids` only the listed users are returned (unknown ids are skipped).
+    With `Accept: application/x-ndjson` the whole table (after `cursor`, if any) is streamed
+    instead, one user per line.
+    Unfiltered responses carry the total number of users in `X-Total-Count`.
+    With `fields` only the listed fields (and `id`) are returned.
+    """
+    logger.info(f"Get all users request - ids: {ids}, fields: {fields}")
+    fields = parse_fields(fields)
 
-    for user in users:
-        user_details = get_user_with_details(db, user.id)
-        if user_details:
-            result.append(user_details)
+    query = db.query(User)
+    user_ids = parse_ids(ids) if ids is not None else None
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    elif NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        after_id = decode_cursor(cursor) if cursor is not None else 0
+        logger.info(f"Streaming all users as NDJSON - after user_id: {after_id}")
+        return StreamingResponse(
+            stream_users_ndjson(after_id, fields),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers={"X-Total-Count": str(get_user_stats(db).total_users)}
+        )
+
+    not_modified = check_users_etag(db, request, response)
+    if not_modified:
+        logger.info("Get all users completed - not modified")
+        return not_modified
+    if ids is None:
+        response.headers["X-Total-Count"] = str(get_user_stats(db).total_users)
+
+    if VIRTUAL_BACKEND:
+        result = get_virtual_users_page(db, user_ids, request, response, cursor, limit, fields)
+    else:
+        result = get_users_page(db, query, request, response, cursor, limit, fields=fields)
 
     logger.info(f"Get all users completed - returned {len(result)} users")
-    return result
+    return users_response(result, response, fields)
 
 
 @app.get("/v1/users/{user_id}", response_model=UserResponse)
-async def get_user(user_id: int, db: Session = Depends(get_db)):
-    """Get user by ID"""
-    logger.info(f"Get user request - user_id: {user_id}")
-
-    user_details = get_user_with_details(db, user_id)
+def get_user(
+        user_id: int,
+        request: Request,
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return (default: all)"),
+        db: Session = Depends(get_db)
+):
+    """
+    Get user by ID, served from the user cache when possible.
 
-    if not user_details:
-        logger.warning(f"User not found - user_id: {user_id}")
-        raise HTTPException(status_code=404, detail="User not found")
+    Responses carry a strong ETag; a matching If-None-Match is answered with 304 without
+    loading the user's rows.
+    With `fields` only the listed fields (and `id`) are returned; projections are not cached.
+    """
+    logger.info(f"Get user request - user_id: {user_id}, fields: {fields}")
+    fields = parse_fields(fields)
+
+    cached = user_cache.get(user_id) if fields is None else None
+    if cached is None:
+        cache_version = user_cache.version
+        updated_at = db.query(User.updated_at).filter(User.id == user_id).scalar()
+        if updated_at is None and VIRTUAL_BACKEND and live_virtual_ids(db, [user_id]):
+            updated_at = virtual_created_at(user_id)
+
+        if updated_at is None:
+            logger.warning(f"User not found - user_id: {user_id}")
+            raise HTTPException(status_code=404, detail="User not found")
+
+        etag = user_etag(user_id, updated_at, fields)
+        if etag_matches(request, etag):
+            logger.info(f"Get user completed - not modified - user_id: {user_id}")
+            return Response(status_code=304, headers={"ETag": etag})
+
+        user_details = get_user_with_details(db, user_id, fields)
+        if not user_details:
+            logger.warning(f"User not found - user_id: {user_id}")
+            raise HTTPException(status_code=404, detail="User not found")
+
+        payload = encode_user(user_details, fields)
+        cached = (etag, payload)
+        if fields is None:
+            user_cache.set(user_id, cached, cache_version)
+
+    etag, payload = cached
+    if etag_matches(request, etag):
+        logger.info(f"Get user completed - not modified - user_id: {user_id}")
+        return Response(status_code=304, headers={"ETag": etag})
 
     logger.info(f"Get user completed successfully - user_id: {user_id}")
-    return user_details
+    return Response(content=payload, media_type="application/json", headers={"ETag": etag})
 
 
 @app.post("/v1/users", response_model=UserResponse, status_code=201)
-async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
+def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
     logger.info(f"Create user request - email: {user_data.email}")
 
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
-    if existing_user:
+    if registered_emails(db, [user_data.email]):
         logger.warning(f"User creation failed - email already exists: {user_data.email}")
         raise HTTPException(status_code=400, detail="User with such email is already registered")
 
@@ -339,10 +1251,15 @@ async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
             salary=user_data.salary,
             about_me=user_data.about_me
         )
+        if INLINE_STORAGE:
+            if user_data.address:
+                set_inline_details(db_user, "address", user_data.address)
+            if user_data.credit_card:
+                set_inline_details(db_user, "credit_card", user_data.credit_card)
         db.add(db_user)
         db.flush()
 
-        if user_data.address:
+        if user_data.address and not INLINE_STORAGE:
             db_address = Address(
                 user_id=db_user.id,
                 country=user_data.address.country,
@@ -354,7 +1271,7 @@ async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
             db.flush()
             logger.info(f"Address created for user_id: {db_user.id}")
 
-        if user_data.credit_card:
+        if user_data.credit_card and not INLINE_STORAGE:
             db_credit_card = CreditCard(
                 user_id=db_user.id,
                 num=user_data.credit_card.num,
@@ -373,15 +1290,197 @@ async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
         db.rollback()
         raise error
 
-    return get_user_with_details(db, db_user.id)
+    user = get_user_with_details(db, db_user.id)
+    publish_user_event("created", user)
+    return user
+
+
+@app.post("/v1/users/batch", response_model=BatchCreateResponse)
+def create_users_batch(users_data: List[UserCreate], db: Session = Depends(get_db)):
+    """
+    Create many users in one transaction.
+
+    Users whose email is already registered, or repeated earlier in the batch, are reported
+    with status_code 400 in `results` (in request order) and the rest are created.
+    """
+    logger.info(f"Batch create users request - users: {len(users_data)}")
+
+    if len(users_data) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"No more than {MAX_BATCH_SIZE} users can be created at once")
+
+    emails = [user_data.email for user_data in users_data]
+    registered = registered_emails(db, emails)
+
+    results = []
+    accepted = []
+    batch_emails = set()
+    for index, user_data in enumerate(users_data):
+        if user_data.email in registered:
+            error = "User with such email is already registered"
+        elif user_data.email in batch_emails:
+            error = "Email is repeated earlier in the batch"
+        else:
+            batch_emails.add(user_data.email)
+            results.append(BatchCreateResult(index=index, status_code=201))
+            accepted.append(user_data)
+            continue
+        results.append(BatchCreateResult(index=index, status_code=400, error=error))
+
+    try:
+        user_ids = bulk_insert_users(db, [user_data.model_dump() for user_data in accepted])
+        db.commit()
+    except Exception as error:
+        logger.error(f"Error creating users batch - error: {str(error)}")
+        db.rollback()
+        raise error
+
+    created_users = get_users_with_details(db, db.query(User).filter(User.id.in_(user_ids)))
+    for user in created_users:
+        publish_user_event("created", user)
+    users_by_id = {user["id"]: user for user in created_users}
+    created_results = (result for result in results if result.status_code == 201)
+    for result, user_id in zip(created_results, user_ids):
+        result.user = UserResponse.model_validate(users_by_id[user_id])
+
+    logger.info(f"Batch create users completed - created: {len(user_ids)}, failed: {len(results) - len(user_ids)}")
+    return BatchCreateResponse(created=len(user_ids), failed=len(results) - len(user_ids), results=results)
+
+
+def validation_error_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" for detail in error.errors())
+
+
+def import_users_chunk(db: Session, chunk: List[tuple]) -> tuple:
+    """
+    Create the users of `chunk`, (line, UserCreate) pairs, in one transaction like a batch. Returns
+    the number of users created and the (line, error) of the rows that weren't.
+    """
+    registered = registered_emails(db, [user_data.email for _, user_data in chunk])
+    failures = []
+    accepted = []
+    chunk_emails = set()
+    for line, user_data in chunk:
+        if user_data.email in registered:
+            failures.append((line, "User with such email is already registered"))
+        elif user_data.email in chunk_emails:
+            failures.append((line, "Email is repeated earlier in the import"))
+        else:
+            chunk_emails.add(user_data.email)
+            accepted.append(user_data)
+
+    try:
+        user_ids = bulk_insert_users(db, [user_data.model_dump() for user_data in accepted])
+        db.commit()
+    except Exception as error:
+        logger.error(f"Error importing users - error: {str(error)}")
+        db.rollback()
+        raise error
+
+    if broadcaster.active:
+        for user in get_users_with_details(db, db.query(User).filter(User.id.in_(user_ids))):
+            publish_user_event("created", user)
+    db.expunge_all()
+    return len(user_ids), failures
+
+
+def import_user_rows(rows: Iterator[ImportRow]) -> ImportResponse:
+    """
+    Validate the rows of an import (see user_import.py) with the POST /v1/users rules and create
+    their users, committing every IMPORT_CHUNK_SIZE valid rows. Memory is bounded by one chunk
+    and the first IMPORT_MAX_ERRORS errors, whatever the number of rows.
+    """
+    started = time.perf_counter()
+    report = ImportResponse(rows=0, created=0, failed=0, errors=[], seconds=0, rows_per_second=0)
+
+    def add_failures(failures: List[tuple]):
+        report.failed += len(failures)
+        for line, error in failures[:IMPORT_MAX_ERRORS - len(report.errors)]:
+            report.errors.append(ImportRowError(line=line, error=error))
+
+    db = SessionLocal()
+
+    def commit(chunk: List[tuple]):
+        created, failures = import_users_chunk(db, chunk)
+        report.created += created
+        add_failures(failures)
+
+    try:
+        chunk = []
+        for line, data, error in rows:
+            report.rows += 1
+            if error is None:
+                try:
+                    chunk.append((line, UserCreate.model_validate(data)))
+                except ValidationError as validation_error:
+                    error = validation_error_message(validation_error)
+            if error is not None:
+                add_failures([(line, error)])
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                commit(chunk)
+                chunk = []
+        if chunk:
+            commit(chunk)
+    finally:
+        db.close()
+
+    report.seconds = round(time.perf_counter() - started, 3)
+    report.rows_per_second = round(report.rows / report.seconds, 1) if report.seconds else 0
+    return report
+
+
+@app.post("/v1/users/import", response_model=ImportResponse)
+async def import_users(request: Request):
+    """
+    Create users from a streamed NDJSON (application/x-ndjson) or CSV (text/csv) body.
+
+    NDJSON rows are POST /v1/users bodies. CSV has a header row naming the columns: the user
+    fields, and `address_<column>` / `credit_card_<column>` for the address and credit card.
+    Every row is validated like POST /v1/users and users are committed in chunks of
+    IMPORT_CHUNK_SIZE as the body arrives, so memory doesn't grow with the file. Rows that
+    fail are counted and listed with their line and error (up to IMPORT_MAX_ERRORS); users of
+    committed chunks stay created if the import is interrupted.
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    logger.info(f"Import users request - format: {media_type}")
+    if media_type == NDJSON_MEDIA_TYPE:
+        parse = parse_ndjson
+    elif media_type == CSV_MEDIA_TYPE:
+        required = [name for name, field in UserCreate.model_fields.items() if field.is_required()]
+        parse = functools.partial(parse_csv, required_columns=required)
+    else:
+        raise HTTPException(
+            status_code=415, detail=f"Send the users as {NDJSON_MEDIA_TYPE} or {CSV_MEDIA_TYPE}"
+        )
+
+    body = request.stream()
+
+    async def receive_chunk():
+        return await anext(body, None)
+
+    def read_body():
+        # Called from the import thread, each chunk is awaited on the event loop as it arrives
+        while (chunk := from_thread.run(receive_chunk)) is not None:
+            yield chunk
+
+    try:
+        report = await run_in_threadpool(import_user_rows, parse(read_body(), IMPORT_MAX_LINE_BYTES))
+    except ImportFormatError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    logger.info(f"Import users completed - rows: {report.rows}, created: {report.created}, "
+                f"failed: {report.failed}, {report.rows_per_second} rows/s")
+    return report
 
 
 @app.put("/v1/users/{user_id}", response_model=UserResponse)
-async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends(get_db)):
+def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends(get_db)):
     """Update user by ID"""
     logger.info(f"Update user request - user_id: {user_id}")
 
     db_user = db.query(User).filter(User.id == user_id).first()
+    if not db_user and VIRTUAL_BACKEND and live_virtual_ids(db, [user_id]):
+        # A virtual user is stored as it is on its first update, then updated like any other
+        db_user = materialize_virtual_user(db, user_id)
     if not db_user:
         logger.warning(f"Update user failed - user not found: {user_id}")
         raise HTTPException(status_code=404, detail="User not found")
@@ -393,6 +1492,8 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
             db_user.surname = user_data.surname
         if user_data.email is not None:
             existing_user = db.query(User).filter(User.email == user_data.email, User.id != user_id).first()
+            if not existing_user and VIRTUAL_BACKEND:
+                existing_user = find_virtual_emails(db, [user_data.email]).get(user_data.email) not in (None, user_id)
             if existing_user:
                 logger.warning(f"Update user failed - email already exists: {user_data.email}")
                 raise HTTPException(status_code=400, detail="Email already registered")
@@ -408,7 +1509,12 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
         if user_data.salary is not None:
             db_user.salary = user_data.salary
 
-        if user_data.address is not None:
+        # Only an existing address and credit card are updated, with either storage
+        if user_data.address is not None and INLINE_STORAGE:
+            if db_user.address_country is not None:
+                set_inline_details(db_user, "address", user_data.address)
+                logger.info(f"Address updated for user_id: {user_id}")
+        elif user_data.address is not None:
             db_address = db.query(Address).filter(Address.user_id == user_id).first()
             if db_address:
                 db_address.country = user_data.address.country
@@ -417,7 +1523,11 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
                 db_address.flat_house = user_data.address.flat_house
                 logger.info(f"Address updated for user_id: {user_id}")
 
-        if user_data.credit_card is not None:
+        if user_data.credit_card is not None and INLINE_STORAGE:
+            if db_user.credit_card_num is not None:
+                set_inline_details(db_user, "credit_card", user_data.credit_card)
+                logger.info(f"Credit card updated for user_id: {user_id}")
+        elif user_data.credit_card is not None:
             db_credit_card = db.query(CreditCard).filter(CreditCard.user_id == user_id).first()
             if db_credit_card:
                 db_credit_card.num = user_data.credit_card.num
@@ -425,7 +1535,10 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
                 db_credit_card.exp_date = user_data.credit_card.exp_date
                 logger.info(f"Credit card updated for user_id: {user_id}")
 
+        # Address and credit card changes don't touch the users row, bump its version explicitly
+        db_user.updated_at = datetime.datetime.utcnow()
         db.commit()
+        user_cache.invalidate(user_id)
         logger.info(f"User updated successfully - user_id: {user_id}")
 
     except HTTPException:
@@ -435,27 +1548,42 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
         db.rollback()
         raise error
 
-    return get_user_with_details(db, user_id)
+    user = get_user_with_details(db, user_id)
+    publish_user_event("updated", user)
+    return user
 
 
 @app.delete("/v1/users/{user_id}", status_code=204)
-async def delete_user(user_id: int, db: Session = Depends(get_db)):
+def delete_user(user_id: int, db: Session = Depends(get_db)):
     """Delete user by ID"""
     logger.info(f"Delete user request - user_id: {user_id}")
 
     db_user = db.query(User).filter(User.id == user_id).first()
+    if not db_user and VIRTUAL_BACKEND and live_virtual_ids(db, [user_id]):
+        delete_virtual_users(db, [user_id])
+        db.commit()
+        user_cache.invalidate(user_id)
+        publish_user_event("deleted", {"id": user_id})
+        logger.info(f"Virtual user deleted successfully - user_id: {user_id}")
+        return {"message": "User deleted successfully"}
     if not db_user:
         logger.warning(f"Delete user failed - user not found: {user_id}")
         raise HTTPException(status_code=404, detail="User not found")
 
     try:
-        # Delete related records first
-        addresses_deleted = db.query(Address).filter(Address.user_id == user_id).delete()
-        credit_cards_deleted = db.query(CreditCard).filter(CreditCard.user_id == user_id).delete()
-
+        # Delete related records first (with USER_STORAGE=inline they go with the user row)
+        addresses_deleted = credit_cards_deleted = 0
+        if not INLINE_STORAGE:
+            addresses_deleted = db.query(Address).filter(Address.user_id == user_id).delete()
+            credit_cards_deleted = db.query(CreditCard).filter(CreditCard.user_id == user_id).delete()
+
+        if VIRTUAL_BACKEND:
+            delete_virtual_users(db, [user_id])
         # Delete the user
         db.delete(db_user)
         db.commit()
+        user_cache.invalidate(user_id)
+        publish_user_event("deleted", {"id": user_id})
 
         logger.info(f"User deleted successfully - user_id: {user_id}, "
                     f"addresses_deleted: {addresses_deleted}, credit_cards_deleted: {credit_cards_deleted}")
@@ -468,10 +1596,16 @@ async def delete_user(user_id: int, db: Session = Depends(get_db)):
     return {"message": "User deleted successfully"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus metrics"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/health")
 def health_check():
     logger.info("Health check requested")
-    return {"status": "healthy", "timestamp": datetime.datetime.utcnow()}
+    return {"status": "healthy", "timestamp": datetime.datetime.utcnow(), "user_cache": user_cache.stats()}
 
 
 if __name__ == "__main__":
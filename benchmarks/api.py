@@ -0,0 +1,372 @@
+"""
+Load-test and benchmark runner for the UserService API.
+
+Drives a mixed workload (get by id, list, search, create, update, delete) at one or more
+concurrency levels and reports throughput and p50/p95/p99 latency per operation as JSON.
+
+    # seed 10k users into a throw-away database and drive the app in-process (ASGI)
+    python -m benchmarks.api run --users 10000 --concurrency 1,8,32 --output run.json
+
+    # same dataset, served by a local uvicorn process
+    python -m benchmarks.api run --target uvicorn --users 10000
+
+    # an already running server (no seeding)
+    python -m benchmarks.api run --base-url http://localhost:8000
+
+    # replay a traffic capture: JSON lines with method, path and optional params/json
+    python -m benchmarks.api run --replay capture.jsonl
+
+    # compare two runs
+    python -m benchmarks.api compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+DEFAULT_MIX = "get=50,list=20,search=15,create=5,update=5,delete=5"
+SAMPLE_IDS = 10000
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        weights[operation.strip()] = float(weight)
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list, errors: int, statuses: dict) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "mean_ms": sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+class Dataset:
+    """Ids and search terms known to exist on the target, kept up to date by creates and deletes"""
+
+    def __init__(self):
+        self.ids = []
+        self.terms = []
+
+    async def load(self, client: httpx.AsyncClient):
+        cursor = None
+        while len(self.ids) < SAMPLE_IDS:
+            params = {"limit": 1000}
+            if cursor:
+                params["cursor"] = cursor
+            response = await client.get("/v1/users", params=params)
+            response.raise_for_status()
+            for user in response.json():
+                self.ids.append(user["id"])
+                self.terms.append(user["name"][:4])
+            cursor = response.headers.get("x-next-cursor")
+            if not cursor:
+                break
+        if not self.ids:
+            raise SystemExit("The target has no users to benchmark against")
+
+    def random_id(self):
+        return random.choice(self.ids)
+
+    def pop_random_id(self):
+        if len(self.ids) <= 1:
+            return self.ids[0]
+        return self.ids.pop(random.randrange(len(self.ids)))
+
+
+def new_user_payload() -> dict:
+    from generate_users import generate_user_data
+
+    user_data = generate_user_data()
+    user_data["email"] = f"bench-{uuid.uuid4().hex}@example.org"
+    user_data["date_of_birth"] = user_data["date_of_birth"].isoformat()
+    return user_data
+
+
+# Operations return the request to send as (method, path, params, json)
+def op_get(dataset):
+    return "GET", f"/v1/users/{dataset.random_id()}", None, None
+
+
+def op_list(dataset):
+    return "GET", "/v1/users", {"limit": 100}, None
+
+
+def op_search(dataset):
+    return "GET", "/v1/users/search", {"name": random.choice(dataset.terms), "limit": 100}, None
+
+
+def op_create(dataset):
+    return "POST", "/v1/users", None, new_user_payload()
+
+
+def op_update(dataset):
+    return "PUT", f"/v1/users/{dataset.random_id()}", None, {"salary": round(random.uniform(30000, 200000), 2)}
+
+
+def op_delete(dataset):
+    return "DELETE", f"/v1/users/{dataset.pop_random_id()}", None, None
+
+
+OPERATIONS = {
+    "get": op_get,
+    "list": op_list,
+    "search": op_search,
+    "create": op_create,
+    "update": op_update,
+    "delete": op_delete,
+}
+
+
+def load_replay(path: str) -> list:
+    """Read a traffic capture, skipping lines that don't describe a request"""
+    requests = []
+    with open(path) as capture:
+        for line in capture:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            path_ = entry.get("path") or entry.get("url")
+            if not entry.get("method") or not path_:
+                continue
+            requests.append({
+                "method": entry["method"].upper(),
+                "path": path_,
+                "params": entry.get("params") or entry.get("query"),
+                "json": entry.get("json") or entry.get("body"),
+            })
+    if not requests:
+        raise SystemExit(f"{path} has no replayable requests (lines need 'method' and 'path')")
+    return requests
+
+
+async def run_level(client, dataset, concurrency: int, total: int, weights: dict, replay: list):
+    """Send `total` requests with `concurrency` workers, return the per-operation summary"""
+    operations = list(weights)
+    operation_weights = [weights[operation] for operation in operations]
+    samples = {}
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            if replay:
+                request = replay[(total - remaining - 1) % len(replay)]
+                name = f"{request['method']} {request['path'].split('?')[0]}"
+                method, path, params, body = request["method"], request["path"], request["params"], request["json"]
+            else:
+                name = random.choices(operations, operation_weights)[0]
+                method, path, params, body = OPERATIONS[name](dataset)
+
+            latencies, statuses, errors = samples.setdefault(name, ([], {}, [0]))
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params, json=body)
+                status = str(response.status_code)
+                if response.status_code >= 500:
+                    errors[0] += 1
+                elif name == "create" and response.status_code == 201:
+                    dataset.ids.append(response.json()["id"])
+            except httpx.HTTPError:
+                status = "error"
+                errors[0] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [latency for latencies, _, _ in samples.values() for latency in latencies]
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "duration_s": elapsed,
+        "throughput_rps": total / elapsed,
+        "overall": summarize(all_latencies, sum(errors[0] for _, _, errors in samples.values()), {}),
+        "operations": {
+            name: summarize(latencies, errors[0], statuses)
+            for name, (latencies, statuses, errors) in sorted(samples.items())
+        },
+    }
+
+
+def start_uvicorn(database_path: str, users: int, seed: int, port: int):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{database_path}", USERS_NUMBER=str(users), USERS_SEED=str(seed))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("uvicorn exited during startup")
+        try:
+            httpx.get(f"{base_url}/health", timeout=1)
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("uvicorn didn't become healthy in time")
+
+
+async def drive(args, client: httpx.AsyncClient):
+    replay = load_replay(args.replay) if args.replay else None
+    dataset = Dataset()
+    if not replay:
+        await dataset.load(client)
+
+    weights = parse_mix(args.mix)
+    results = []
+    for concurrency in args.concurrency:
+        level = await run_level(client, dataset, concurrency, args.requests, weights, replay)
+        print(f"concurrency {concurrency:>4}: {level['throughput_rps']:8.1f} req/s, "
+              f"p50 {level['overall']['p50_ms']:.2f} ms, p99 {level['overall']['p99_ms']:.2f} ms", file=sys.stderr)
+        results.append(level)
+    return results
+
+
+def run(args):
+    random.seed(args.seed)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    config = {key: value for key, value in vars(args).items() if key != "func"}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, "bench.db")
+
+        if args.base_url:
+            client = httpx.AsyncClient(base_url=args.base_url, timeout=60)
+            results = asyncio.run(drive_with(client, args))
+        elif args.target == "uvicorn":
+            process, base_url = start_uvicorn(database_path, args.users, args.seed, args.port)
+            try:
+                results = asyncio.run(drive_with(httpx.AsyncClient(base_url=base_url, timeout=60), args))
+            finally:
+                process.terminate()
+                process.wait()
+        else:
+            # database.py reads DATABASE_URL at import, so the app is imported only now
+            os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+            sys.path.insert(0, REPO_ROOT)
+            from app import app
+            from generate_users import generate_test_users
+            from models import init_db
+
+            logging.getLogger("app").setLevel(logging.WARNING)
+            init_db()
+            generate_test_users(args.users, seed=args.seed)
+            transport = httpx.ASGITransport(app=app)
+            results = asyncio.run(drive_with(httpx.AsyncClient(transport=transport, base_url="http://bench"), args))
+
+    report = {"config": config, "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output)
+    else:
+        print(output)
+
+
+async def drive_with(client: httpx.AsyncClient, args):
+    async with client:
+        return await drive(args, client)
+
+
+def compare(args):
+    """Print the relative change of throughput and latency percentiles between two reports"""
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = {level["concurrency"]: level for level in json.load(before_file)["results"]}
+        after = {level["concurrency"]: level for level in json.load(after_file)["results"]}
+
+    def change(old, new):
+        return (new - old) / old * 100 if old else None
+
+    comparison = []
+    for concurrency in sorted(set(before) & set(after)):
+        old, new = before[concurrency], after[concurrency]
+        operations = {}
+        for name in sorted(set(old["operations"]) | set(new["operations"])):
+            old_operation, new_operation = old["operations"].get(name), new["operations"].get(name)
+            if not old_operation or not new_operation:
+                continue
+            operations[name] = {
+                metric: {
+                    "before": old_operation[metric],
+                    "after": new_operation[metric],
+                    "change_pct": change(old_operation[metric], new_operation[metric]),
+                }
+                for metric in ("p50_ms", "p95_ms", "p99_ms")
+            }
+        comparison.append({
+            "concurrency": concurrency,
+            "throughput_rps": {
+                "before": old["throughput_rps"],
+                "after": new["throughput_rps"],
+                "change_pct": change(old["throughput_rps"], new["throughput_rps"]),
+            },
+            "operations": operations,
+        })
+
+    print(json.dumps(comparison, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a benchmark")
+    run_parser.add_argument("--target", choices=["asgi", "uvicorn"], default="asgi",
+                            help="drive the app in-process or through a local uvicorn (ignored with --base-url)")
+    run_parser.add_argument("--base-url", help="benchmark an already running server instead")
+    run_parser.add_argument("--users", type=int, default=1000, help="users to seed")
+    run_parser.add_argument("--seed", type=int, default=42, help="seed of the dataset and the workload")
+    run_parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")],
+                            default=[1, 8, 32], help="comma-separated concurrency levels")
+    run_parser.add_argument("--requests", type=int, default=1000, help="requests per concurrency level")
+    run_parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights")
+    run_parser.add_argument("--replay", help="JSON lines traffic capture to replay instead of the mix")
+    run_parser.add_argument("--port", type=int, default=8765, help="port of the local uvicorn")
+    run_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
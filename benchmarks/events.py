@@ -0,0 +1,181 @@
+"""
+Load test of GET /v1/users/events (Server-Sent Events) on a local uvicorn process.
+
+Opens `--subscribers` idle event streams and reports the server's memory per subscriber (RSS
+growth over the open streams) and the time for an update to reach every subscriber. Then one
+subscriber stops reading during a burst of updates and is expected to be dropped while the
+readers keep up.
+
+    python -m benchmarks.events --subscribers 5000
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.api import new_user_payload, start_uvicorn
+
+RSS_SETTLE_SECONDS = 1.0
+
+
+def rss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    raise RuntimeError("VmRSS not found")
+
+
+class Subscriber:
+    """A raw SSE connection, lighter than an HTTP client per stream"""
+
+    def __init__(self, port: int, receive_buffer: int = 0):
+        self.port = port
+        self.receive_buffer = receive_buffer
+        self.events = asyncio.Queue()
+        self.reader = self.writer = None
+
+    async def connect(self):
+        sock = socket.socket()
+        if self.receive_buffer:
+            # A small TCP window, so the server's queue fills instead of the kernel buffers
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", self.port))
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.writer.write(b"GET /v1/users/events HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n")
+        await self.writer.drain()
+        status = await self.reader.readline()
+        if b" 200 " not in status:
+            raise RuntimeError(f"Subscribing failed: {status!r}")
+        # Headers, then the ": subscribed" comment of the stream
+        while not (await self.reader.readline()).endswith(b"subscribed\n"):
+            pass
+
+    async def read_events(self):
+        """Queue the name of every event received, until the stream ends"""
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            if line.startswith(b"event: "):
+                await self.events.put(line[7:].strip().decode())
+
+    def close(self):
+        self.writer.close()
+
+
+async def fan_out_latency(client: httpx.AsyncClient, subscribers: list, user_id: int, samples: int) -> list:
+    """Seconds from each update request until all subscribers received its event"""
+    latencies = []
+    for sample in range(samples):
+        started = time.perf_counter()
+        response = await client.put(f"/v1/users/{user_id}", json={"company": f"Bench {sample}"})
+        response.raise_for_status()
+        for subscriber in subscribers:
+            assert await subscriber.events.get() == "updated"
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def slow_subscriber_dropped(client: httpx.AsyncClient, port: int, user_id: int, updates: int) -> dict:
+    """Burst `updates` while one subscriber reads nothing, see which streams survive"""
+    readers = [Subscriber(port) for _ in range(10)]
+    slow = Subscriber(port, receive_buffer=4096)
+    for subscriber in readers + [slow]:
+        await subscriber.connect()
+    reading = [asyncio.create_task(subscriber.read_events()) for subscriber in readers]
+
+    semaphore = asyncio.Semaphore(16)
+
+    async def update(index: int):
+        async with semaphore:
+            await client.put(f"/v1/users/{user_id}", json={"company": "x" * 8000 + str(index)})
+
+    await asyncio.gather(*(update(index) for index in range(updates)))
+    await asyncio.sleep(1)
+
+    # The slow subscriber catches up now: everything it was sent, then "dropped" if it was dropped
+    slow_events = []
+    slow_task = asyncio.create_task(slow.read_events())
+    await asyncio.sleep(2)
+    while not slow.events.empty():
+        slow_events.append(slow.events.get_nowait())
+    for subscriber in readers + [slow]:
+        subscriber.close()
+    for task in reading + [slow_task]:
+        task.cancel()
+    return {
+        "reader_events": min(subscriber.events.qsize() for subscriber in readers),
+        "slow_events": len([event for event in slow_events if event != "dropped"]),
+        "slow_dropped": "dropped" in slow_events,
+    }
+
+
+async def drive(args, base_url: str, pid: int):
+    port = int(base_url.rsplit(":", 1)[1])
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        user_id = (await client.post("/v1/users", json=new_user_payload())).json()["id"]
+
+        # Warm up the code paths of a subscription before the baseline
+        warmup = Subscriber(port)
+        await warmup.connect()
+        warmup.close()
+        await asyncio.sleep(RSS_SETTLE_SECONDS)
+        baseline = rss_kib(pid)
+
+        subscribers = []
+        started = time.perf_counter()
+        for start in range(0, args.subscribers, 500):
+            batch = [Subscriber(port) for _ in range(min(500, args.subscribers - start))]
+            await asyncio.gather(*(subscriber.connect() for subscriber in batch))
+            subscribers.extend(batch)
+        connect_s = time.perf_counter() - started
+        await asyncio.sleep(RSS_SETTLE_SECONDS)
+        subscribed = rss_kib(pid)
+        print(f"{args.subscribers} subscribers connected in {connect_s:.1f}s, "
+              f"RSS {baseline / 1024:.1f} -> {subscribed / 1024:.1f} MiB: "
+              f"{(subscribed - baseline) / args.subscribers:.1f} KiB per subscriber")
+
+        reading = [asyncio.create_task(subscriber.read_events()) for subscriber in subscribers]
+        latencies = await fan_out_latency(client, subscribers, user_id, args.samples)
+        print(f"update -> all {args.subscribers} subscribers: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+              f"max {max(latencies) * 1000:.1f} ms")
+        for subscriber in subscribers:
+            subscriber.close()
+        for task in reading:
+            task.cancel()
+
+        result = await slow_subscriber_dropped(client, port, user_id, args.burst)
+        print(f"burst of {args.burst} updates: readers got {result['reader_events']}, the slow subscriber "
+              f"{'was dropped' if result['slow_dropped'] else 'was not dropped'} "
+              f"after {result['slow_events']} events")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=20, help="updates timed through the subscribers")
+    parser.add_argument("--burst", type=int, default=1000, help="updates sent past the slow subscriber")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    os.environ.setdefault("MAX_EVENT_SUBSCRIBERS", str(args.subscribers + 100))
+    with tempfile.TemporaryDirectory() as directory:
+        process, base_url = start_uvicorn(os.path.join(directory, "bench.db"), args.users, args.seed, args.port)
+        try:
+            asyncio.run(drive(args, base_url, process.pid))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
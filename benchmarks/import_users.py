@@ -0,0 +1,97 @@
+"""
+Load test of POST /v1/users/import on a local uvicorn process.
+
+Streams generated NDJSON or CSV bodies of increasing size and reports the throughput (rows/s)
+and the server's memory after each one, which shouldn't grow with the body size once SQLite's
+page cache (SQLITE_CACHE_SIZE) and memory-mapped pages (SQLITE_MMAP_SIZE) are full.
+
+    python -m benchmarks.import_users --rows 10000,100000,1000000 --format csv
+"""
+import argparse
+import csv
+import io
+import os
+import tempfile
+import uuid
+
+import httpx
+import orjson
+
+from benchmarks.api import new_user_payload, start_uvicorn
+from models import NESTED_FIELDS
+
+TEMPLATES = 200
+
+
+def memory_mib(pid: int) -> str:
+    """Peak RSS, and current anonymous RSS (RSS without the mapped database file)"""
+    values = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmHWM", "RssAnon"):
+                values[key] = int(value.split()[0]) / 1024
+    return f"peak RSS {values['VmHWM']:.1f} MiB, anonymous RSS {values['RssAnon']:.1f} MiB"
+
+
+def csv_line(values: list) -> bytes:
+    output = io.StringIO()
+    csv.writer(output).writerow(values)
+    return output.getvalue().encode()
+
+
+def generate_body(rows: int, body_format: str, templates: list):
+    """`rows` users made of the `templates` with unique emails, a few hundred rows per chunk"""
+    prefix = uuid.uuid4().hex[:8]
+    if body_format == "csv":
+        flat_fields = [field for field in templates[0] if field not in NESTED_FIELDS]
+        nested = [(field, column) for field, (_, columns) in NESTED_FIELDS.items() for column in columns]
+        yield csv_line(flat_fields + [f"{field}_{column}" for field, column in nested])
+
+    lines = []
+    for row in range(rows):
+        user = dict(templates[row % len(templates)], email=f"import-{prefix}-{row}@example.org")
+        if body_format == "csv":
+            values = [user[field] for field in flat_fields] + [user[field][column] for field, column in nested]
+            lines.append(csv_line(values))
+        else:
+            lines.append(orjson.dumps(user) + b"\n")
+        if len(lines) == 500:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000", help="comma-separated body sizes, imported in order")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    content_type = "text/csv" if args.format == "csv" else "application/x-ndjson"
+    templates = [new_user_payload() for _ in range(TEMPLATES)]
+    with tempfile.TemporaryDirectory() as directory:
+        process, base_url = start_uvicorn(os.path.join(directory, "bench.db"), args.users, args.seed, args.port)
+        try:
+            print(f"server after startup: {memory_mib(process.pid)}")
+            with httpx.Client(base_url=base_url, timeout=None) as client:
+                for rows in (int(value) for value in args.rows.split(",")):
+                    response = client.post(
+                        "/v1/users/import", content=generate_body(rows, args.format, templates),
+                        headers={"Content-Type": content_type}
+                    )
+                    response.raise_for_status()
+                    report = response.json()
+                    print(f"{rows} {args.format} rows: created {report['created']}, failed {report['failed']}, "
+                          f"{report['rows_per_second']:.0f} rows/s, server {memory_mib(process.pid)}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
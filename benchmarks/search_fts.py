@@ -0,0 +1,113 @@
+"""
+Compare /v1/users/search filtering through the trigram FTS5 index with the ILIKE scan.
+
+Builds a throw-away database per size and times the same random substring queries on
+both paths. Usage:
+
+    python -m benchmarks.search_fts [sizes...]     # default: 10000 100000 1000000
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from faker import Faker
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app import apply_text_search
+from models import Base, User
+
+QUERIES = 50
+INSERT_CHUNK = 10000
+EMAIL_DOMAINS = ['gmail.com', 'yahoo.com', 'hotmail.com', 'outlook.com', 'company.com', 'example.org']
+
+
+def populate(engine, count: int):
+    """Insert `count` users built from pools of Faker names (generating each row with Faker is too slow for 1M)"""
+    fake = Faker()
+    first_names = [fake.first_name() for _ in range(500)]
+    last_names = [fake.last_name() for _ in range(500)]
+
+    for start in range(0, count, INSERT_CHUNK):
+        rows = []
+        for i in range(start, min(start + INSERT_CHUNK, count)):
+            name = random.choice(first_names)
+            surname = random.choice(last_names)
+            rows.append({
+                "name": name,
+                "surname": surname,
+                "email": f"{name.lower()}.{surname.lower()}{i}@{random.choice(EMAIL_DOMAINS)}",
+                "about_me": "Benchmark user",
+            })
+        with engine.begin() as connection:
+            connection.execute(User.__table__.insert(), rows)
+
+    return first_names + last_names
+
+
+def sample_terms(names: list):
+    terms = []
+    for _ in range(QUERIES):
+        column_name = random.choice(["name", "surname", "email"])
+        word = random.choice(names).lower()
+        length = random.randint(3, min(5, len(word))) if len(word) >= 3 else len(word)
+        start = random.randint(0, len(word) - length)
+        terms.append({column_name: word[start:start + length]})
+    return terms
+
+
+def like_query(db: Session, terms: dict):
+    query = db.query(User.id)
+    for column_name, value in terms.items():
+        query = query.filter(getattr(User, column_name).ilike(f"%{value}%"))
+    return query
+
+
+def fts_query(db: Session, terms: dict):
+    query, _ = apply_text_search(db.query(User.id), terms)
+    return query
+
+
+def time_queries(db: Session, build_query, terms_list: list):
+    timings = []
+    matches = 0
+    for terms in terms_list:
+        started = time.perf_counter()
+        matches += len(build_query(db, terms).all())
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "matches": matches,
+    }
+
+
+def run(count: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+
+        started = time.perf_counter()
+        names = populate(engine, count)
+        print(f"Populated {count} users in {time.perf_counter() - started:.1f}s")
+
+        terms_list = sample_terms(names)
+        with Session(bind=engine) as db:
+            like = time_queries(db, like_query, terms_list)
+            fts = time_queries(db, fts_query, terms_list)
+        engine.dispose()
+
+    assert like["matches"] == fts["matches"], "FTS and LIKE paths returned different results"
+    print(f"{count:>10} users | LIKE p50 {like['p50_ms']:8.2f} ms p95 {like['p95_ms']:8.2f} ms | "
+          f"FTS p50 {fts['p50_ms']:8.2f} ms p95 {fts['p95_ms']:8.2f} ms | "
+          f"speedup x{like['p50_ms'] / fts['p50_ms']:.1f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000]
+    for size in sizes:
+        run(size)
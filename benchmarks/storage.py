@@ -0,0 +1,109 @@
+"""
+Compare the two user storage layouts: USER_STORAGE=tables (addresses and credit_cards
+tables) and USER_STORAGE=inline (columns of the users row).
+
+Builds the same throw-away database (same seed) per layout and times the read and write
+paths of the API on it, then times migrating the tables layout to inline. The layout is
+fixed when models.py is imported, so each one is measured in a process of its own. Usage:
+
+    python -m benchmarks.storage [users]     # default: 10000
+
+For end-to-end numbers run benchmarks.api once per layout and compare the reports:
+
+    USER_STORAGE=tables python -m benchmarks.api run --users 10000 --output tables.json
+    USER_STORAGE=inline python -m benchmarks.api run --users 10000 --output inline.json
+    python -m benchmarks.api compare tables.json inline.json
+"""
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SEED = 42
+SAMPLES = 1000
+PAGE_SIZE = 100
+WRITE_BATCH = 1000
+
+
+def time_calls(call, arguments: list) -> float:
+    """Median duration of `call(argument)` over `arguments`, in ms"""
+    timings = []
+    for argument in arguments:
+        started = time.perf_counter()
+        call(argument)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def measure(count: int) -> dict:
+    """Time the read and write paths with the USER_STORAGE of this process"""
+    with tempfile.TemporaryDirectory() as directory:
+        # database.py reads DATABASE_URL at import, so the app is imported only now
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        from app import get_user_with_details, get_users_after, get_users_with_details
+        from database import SessionLocal
+        from generate_users import bulk_insert_users, generate_test_users, generate_user_data
+        from models import USER_STORAGE, User, init_db, migrate_user_storage
+
+        init_db()
+        generate_test_users(count, seed=SEED, workers=1)
+        random.seed(SEED)
+        user_ids = [random.randint(1, count) for _ in range(SAMPLES)]
+        new_users = [generate_user_data() for _ in range(WRITE_BATCH)]
+
+        db = SessionLocal()
+        try:
+            get_ms = time_calls(lambda user_id: get_user_with_details(db, user_id), user_ids)
+            page_ms = time_calls(
+                lambda user_id: get_users_after(db, db.query(User), user_id, PAGE_SIZE), user_ids[:100]
+            )
+            list_ms = time_calls(lambda _: get_users_with_details(db, db.query(User)), range(3))
+
+            started = time.perf_counter()
+            bulk_insert_users(db, new_users)
+            db.commit()
+            insert_ms = (time.perf_counter() - started) * 1000
+        finally:
+            db.close()
+
+        result = {
+            "storage": USER_STORAGE,
+            "get_ms": get_ms,
+            "page_ms": page_ms,
+            "list_ms": list_ms,
+            "insert_ms": insert_ms,
+            "database_mb": sum(
+                os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+            ) / 2 ** 20,
+        }
+        if USER_STORAGE == "tables":
+            started = time.perf_counter()
+            migrate_user_storage("inline")
+            result["migration_s"] = time.perf_counter() - started
+        return result
+
+
+def run(count: int):
+    for storage in ("tables", "inline"):
+        env = dict(os.environ, USER_STORAGE=storage)
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.storage", "--measure", str(count)],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{count:>8} users | {storage:>6} | get p50 {result['get_ms']:6.2f} ms | "
+              f"page of {PAGE_SIZE} p50 {result['page_ms']:6.2f} ms | list all {result['list_ms']:8.1f} ms | "
+              f"insert {WRITE_BATCH} {result['insert_ms']:6.1f} ms | db {result['database_mb']:.1f} MB")
+        if "migration_s" in result:
+            print(f"{count:>8} users | migration tables -> inline {result['migration_s']:.2f}s")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--measure"]:
+        print(json.dumps(measure(int(sys.argv[2]))))
+    else:
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,41 @@
+import logging
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+DATABASE_URL = os.getenv('DATABASE_URL', "sqlite:///./users.db")
+
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the (single) writer,
+# so reads aren't serialized behind the scheduler's write transactions.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    "synchronous": os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    "mmap_size": int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Negative values are in KiB
+    "cache_size": int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),
+    "temp_store": "MEMORY",
+    "busy_timeout": int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+}
+
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=int(os.getenv('DB_POOL_SIZE', 20)),
+    max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+    pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+    echo=False
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -0,0 +1,91 @@
+import asyncio
+from typing import Optional
+
+
+class Subscription:
+    """A subscriber's bounded queue of encoded events; None ends the stream"""
+
+    def __init__(self, queue_size: int):
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = False
+
+
+class EventBroadcaster:
+    """
+    In-process fan-out of encoded events to subscribers, run on the event loop.
+
+    `publish` may be called from any thread (the route handlers and jobs run in worker threads):
+    the event is handed to the loop with call_soon_threadsafe and put on every subscriber's
+    bounded queue there, so an idle subscriber costs a queue and no thread. A subscriber whose
+    queue is full can't keep up; it is dropped rather than buffered without limit.
+    """
+
+    def __init__(self, max_subscribers: int, queue_size: int):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.published = 0
+        self.dropped = 0
+        self._subscriptions = set()
+        self._loop = None
+
+    @property
+    def active(self) -> bool:
+        """Whether anyone is subscribed, so publishers can skip building events nobody reads"""
+        return self._loop is not None and bool(self._subscriptions)
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def stop(self):
+        """End every stream and stop publishing. Call on the loop."""
+        self._loop = None
+        for subscription in list(self._subscriptions):
+            self._close(subscription)
+        self._subscriptions.clear()
+
+    def subscribe(self) -> Optional[Subscription]:
+        """A new subscription, None when there are already `max_subscribers`. Call on the loop."""
+        if len(self._subscriptions) >= self.max_subscribers:
+            return None
+        subscription = Subscription(self.queue_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def publish(self, message: bytes):
+        """Send `message` to every subscriber. Thread-safe."""
+        loop = self._loop
+        if loop is None or not self._subscriptions:
+            return
+        try:
+            loop.call_soon_threadsafe(self._fan_out, message)
+        except RuntimeError:
+            # The loop was closed during shutdown
+            pass
+
+    def _fan_out(self, message: bytes):
+        self.published += 1
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                subscription.dropped = True
+                self.dropped += 1
+                self._subscriptions.discard(subscription)
+                self._close(subscription)
+
+    @staticmethod
+    def _close(subscription: Subscription):
+        # Pending events are discarded, a dropped subscriber resyncs anyway
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscriptions),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
@@ -1,13 +1,23 @@
+import os
 import random
 import datetime
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from faker import Faker
+from sqlalchemy import insert, select
 from sqlalchemy.orm import Session
 
-from models import User, Address, CreditCard, SessionLocal
+from database import SessionLocal
+from models import User, Address, CreditCard, NESTED_FIELDS, INLINE_STORAGE
 
 fake = Faker()
 
-def generate_about_me(company=None):
+BULK_CHUNK_SIZE = 5000
+USER_FIELDS = ("name", "surname", "email", "phone", "date_of_birth", "gender", "company", "salary", "about_me")
+
+def generate_about_me(company=None, rng=random):
     """Generate a personalized 'about me' description"""
 
     hobbies = [
@@ -40,10 +50,10 @@ def generate_about_me(company=None):
         "master new skills", "achieve work-life balance", "give back to community"
     ]
 
-    selected_hobbies = random.sample(hobbies, random.randint(2, 4))
-    selected_traits = random.sample(personality_traits, random.randint(1, 3))
-    selected_interests = random.sample(interests, random.randint(1, 3))
-    selected_goals = random.sample(life_goals, random.randint(1, 2))
+    selected_hobbies = rng.sample(hobbies, rng.randint(2, 4))
+    selected_traits = rng.sample(personality_traits, rng.randint(1, 3))
+    selected_interests = rng.sample(interests, rng.randint(1, 3))
+    selected_goals = rng.sample(life_goals, rng.randint(1, 2))
 
     about_templates = [
         f"I'm a {', '.join(selected_traits)} person who loves {', '.join(selected_hobbies)}. I'm passionate about {' and '.join(selected_interests)} and always looking to {' and '.join(selected_goals)}.",
@@ -155,15 +165,15 @@ def generate_about_me(company=None):
         f"What makes each moment special? My love for {selected_hobbies[0]}, interest in {selected_interests[0]}, and {selected_traits[0]} perspective on everything. I enjoy {selected_hobbies[1]} while working towards {selected_goals[0]}."
     ]
 
-    return random.choice(about_templates)
+    return rng.choice(about_templates)
 
-def generate_date_of_birth():
+def generate_date_of_birth(rng=random):
     """Generate a realistic date of birth"""
     current_year = datetime.date.today().year
-    age = random.randint(18, 80)
+    age = rng.randint(18, 80)
     birth_year = current_year - age
 
-    birth_month = random.randint(1, 12)
+    birth_month = rng.randint(1, 12)
 
     if birth_month in [1, 3, 5, 7, 8, 10, 12]:
         max_day = 31
@@ -175,18 +185,18 @@ def generate_date_of_birth():
         else:
             max_day = 28
 
-    birth_day = random.randint(1, max_day)
+    birth_day = rng.randint(1, max_day)
 
     return datetime.date(birth_year, birth_month, birth_day)
 
-def generate_credit_card():
+def generate_credit_card(rng=random):
     """Generate a valid-looking credit card number with CVV and expiration date"""
-    card_num = ''.join([str(random.randint(0, 9)) for _ in range(16)])
+    card_num = ''.join([str(rng.randint(0, 9)) for _ in range(16)])
     formatted_num = '-'.join([card_num[i:i+4] for i in range(0, len(card_num), 4)])
-    cvv = ''.join([str(random.randint(0, 9)) for _ in range(3)])
+    cvv = ''.join([str(rng.randint(0, 9)) for _ in range(3)])
     current_year = datetime.datetime.now().year
-    exp_year = random.randint(current_year + 1, current_year + 5)
-    exp_month = random.randint(1, 12)
+    exp_year = rng.randint(current_year + 1, current_year + 5)
+    exp_month = rng.randint(1, 12)
     exp_date = f"{exp_month:02d}/{exp_year}"
 
     return {
@@ -195,47 +205,47 @@ def generate_credit_card():
         "exp_date": exp_date
     }
 
-def generate_address():
+def generate_address(rng=random, faker=fake):
     """Generate a realistic address"""
     return {
-        "country": fake.country(),
-        "city": fake.city(),
-        "street": fake.street_address(),
-        "flat_house": random.choice([
-            f"Apt {random.randint(1, 999)}",
-            f"Unit {random.randint(1, 50)}",
-            f"Suite {random.randint(100, 999)}",
-            f"#{random.randint(1, 999)}",
-            f"House {random.randint(1, 999)}"
+        "country": faker.country(),
+        "city": faker.city(),
+        "street": faker.street_address(),
+        "flat_house": rng.choice([
+            f"Apt {rng.randint(1, 999)}",
+            f"Unit {rng.randint(1, 50)}",
+            f"Suite {rng.randint(100, 999)}",
+            f"#{rng.randint(1, 999)}",
+            f"House {rng.randint(1, 999)}"
         ])
     }
 
-def generate_user_data():
-    """Generate complete user data"""
-    gender = random.choice(['male', 'female', 'other'])
+def generate_user_data(rng=random, faker=fake):
+    """Generate complete user data from `rng` and `faker` (the module-level generators by default)"""
+    gender = rng.choice(['male', 'female', 'other'])
     if gender == 'male':
-        first_name = fake.first_name_male()
+        first_name = faker.first_name_male()
     elif gender == 'female':
-        first_name = fake.first_name_female()
+        first_name = faker.first_name_female()
     else:
-        first_name = fake.first_name()
+        first_name = faker.first_name()
 
-    last_name = fake.last_name()
-    email_domain = random.choice([
+    last_name = faker.last_name()
+    email_domain = rng.choice([
         'gmail.com', 'yahoo.com', 'hotmail.com', 'outlook.com',
         'company.com', 'example.org', 'test.edu', 'business.net'
     ])
-    email = f"{first_name.lower()}.{last_name.lower()}{random.randint(1, 999)}@{email_domain}"
-    phone = fake.phone_number()
-    date_of_birth = generate_date_of_birth()
+    email = f"{first_name.lower()}.{last_name.lower()}{rng.randint(1, 999)}@{email_domain}"
+    phone = faker.phone_number()
+    date_of_birth = generate_date_of_birth(rng)
 
-    if random.random() < 0.7:
-        company = fake.company()
-        salary = round(random.uniform(30000, 200000), 2)
+    if rng.random() < 0.7:
+        company = faker.company()
+        salary = round(rng.uniform(30000, 200000), 2)
     else:
         company = None
         salary = None
-    about_me = generate_about_me(company)
+    about_me = generate_about_me(company, rng)
 
     return {
         "name": first_name,
@@ -247,78 +257,166 @@ def generate_user_data():
         "company": company,
         "salary": salary,
         "about_me": about_me,
-        "address": generate_address(),
-        "credit_card": generate_credit_card()
+        "address": generate_address(rng, faker),
+        "credit_card": generate_credit_card(rng)
     }
 
-def create_user_in_db(db: Session, user_data: dict):
-    """Create a user and related records in the database"""
-    try:
-        db_user = User(
-            name=user_data["name"],
-            surname=user_data["surname"],
-            email=user_data["email"],
-            phone=user_data["phone"],
-            date_of_birth=user_data["date_of_birth"],
-            gender=user_data["gender"],
-            company=user_data["company"],
-            salary=user_data["salary"],
-            about_me=user_data["about_me"]
-        )
-        db.add(db_user)
-        db.flush()
-
-        db_address = Address(
-            user_id=db_user.id,
-            country=user_data["address"]["country"],
-            city=user_data["address"]["city"],
-            street=user_data["address"]["street"],
-            flat_house=user_data["address"]["flat_house"]
-        )
-        db.add(db_address)
-
-        db_credit_card = CreditCard(
-            user_id=db_user.id,
-            num=user_data["credit_card"]["num"],
-            cvv=user_data["credit_card"]["cvv"],
-            exp_date=user_data["credit_card"]["exp_date"]
-        )
-        db.add(db_credit_card)
-
-        db.commit()
-        return db_user.id
+def drop_duplicate_emails(db: Session, users_data: list):
+    """Split users into ones with a new email and ones whose email is taken (in the DB or earlier in the list)"""
+    emails = [user_data["email"] for user_data in users_data]
+    seen = set(db.scalars(select(User.email).where(User.email.in_(emails))))
+
+    unique, duplicates = [], []
+    for user_data in users_data:
+        if user_data["email"] in seen:
+            duplicates.append(user_data)
+        else:
+            seen.add(user_data["email"])
+            unique.append(user_data)
+    return unique, duplicates
+
+
+def bulk_insert_users(db: Session, users_data: list):
+    """
+    Insert users with their address and credit card in three executemany batches.
+
+    User ids come back from INSERT ... RETURNING and are matched to the input by email,
+    so related rows are linked without flushing per user. Emails must already be unique.
+    With USER_STORAGE=inline the address and credit card are part of the user rows instead.
+    The caller commits. Returns the new user ids in the order of `users_data`.
+    """
+    if not users_data:
+        return []
+
+    user_rows = [{field: user_data.get(field) for field in USER_FIELDS} for user_data in users_data]
+    if INLINE_STORAGE:
+        for user_row, user_data in zip(user_rows, users_data):
+            for field, (_, columns) in NESTED_FIELDS.items():
+                details = user_data.get(field) or {}
+                user_row.update({f"{field}_{column}": details.get(column) for column in columns})
+
+    inserted = db.execute(insert(User.__table__).returning(User.id, User.email), user_rows)
+    user_id_by_email = {email: user_id for user_id, email in inserted}
+    user_ids = [user_id_by_email[user_data["email"]] for user_data in users_data]
+    if INLINE_STORAGE:
+        return user_ids
+
+    address_rows = [
+        {"user_id": user_id, **user_data["address"]}
+        for user_id, user_data in zip(user_ids, users_data) if user_data.get("address")
+    ]
+    if address_rows:
+        db.execute(insert(Address.__table__), address_rows)
+
+    credit_card_rows = [
+        {"user_id": user_id, **user_data["credit_card"]}
+        for user_id, user_data in zip(user_ids, users_data) if user_data.get("credit_card")
+    ]
+    if credit_card_rows:
+        db.execute(insert(CreditCard.__table__), credit_card_rows)
+
+    return user_ids
 
-    except Exception as e:
-        db.rollback()
-        print(f"Error creating user {user_data['email']}: {str(e)}")
-        return None
 
-def generate_test_users(count: int = 1000):
-    """Generate specified number of users and insert them into the database"""
-    print(f"Starting generation of {count} users...")
+def generate_users_chunk(seed: int, chunk_index: int, size: int):
+    """
+    Generate `size` users from a seed derived from (`seed`, `chunk_index`).
 
-    db = SessionLocal()
+    A chunk only depends on its own seed, so the dataset is the same whichever process
+    generates it, and has its own generators, so the module-level ones are left alone. Dates (birth dates, card expiry) stay relative to the current year.
+    """
+    chunk_seed = f"{seed}:{chunk_index}"
+    rng = random.Random(chunk_seed)
+    faker = Faker()
+    faker.seed_instance(chunk_seed)
+    return [generate_user_data(rng, faker) for _ in range(size)]
+
+
+def iter_generated_chunks(count: int, seed: int, chunk_size: int, workers: int):
+    """
+    Yield the chunks of a (`seed`, `count`) dataset in order.
+
+    With more than one worker and more than one chunk the chunks are generated by a process
+    pool. At most 2 * `workers` chunks are in flight, so a slow consumer doesn't pile up results.
+    """
+    chunks = [
+        (seed, chunk_index, min(chunk_size, count - chunk_start))
+        for chunk_index, chunk_start in enumerate(range(0, count, chunk_size))
+    ]
+
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield generate_users_chunk(*chunk)
+        return
+
+    # The caller may be a threaded server holding connections and locks: spawned workers start from
+    # a fresh interpreter rather than a fork of that process taken while its other threads run
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=multiprocessing.get_context("spawn"))
+    with pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(generate_users_chunk, *chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def generate_test_users(count: int = 1000, chunk_size: int = BULK_CHUNK_SIZE, seed: int = None, workers: int = None,
+                        bind=None):
+    """
+    Generate specified number of users and insert them into the database, return how many were created.
+
+    Users are generated in chunks of `chunk_size` by `workers` processes (all cores by default,
+    none for a single chunk) and bulk inserted by this process, one transaction per chunk. The same `seed` and `count`
+    give the same users. Generated users whose email is already taken are skipped and
+    reported as failed. Users go to the service database unless another engine is passed as `bind`.
+    Any other error is raised, after the chunks before it were committed.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # One chunk is generated in this process, see iter_generated_chunks
+    workers = max(1, min(workers, -(-count // chunk_size)))
+    print(f"Starting generation of {count} users (seed: {seed}, workers: {workers})...")
+
+    db = SessionLocal(bind=bind) if bind is not None else SessionLocal()
     created_count = 0
     failed_count = 0
+    # Users plus, unless they are stored inline, their address and credit card rows
+    row_count = 0
+    insert_elapsed = 0.0
+    started = time.perf_counter()
 
     try:
-        for i in range(count):
-            user_data = generate_user_data()
-            user_id = create_user_in_db(db, user_data)
-
-            if user_id:
-                created_count += 1
-                if created_count % 100 == 0:  # Progress update every 100 users
-                    print(f"Created {created_count} users...")
-            else:
-                failed_count += 1
-
+        for users_data in iter_generated_chunks(count, seed, chunk_size, workers):
+            insert_started = time.perf_counter()
+            users_data, duplicates = drop_duplicate_emails(db, users_data)
+            bulk_insert_users(db, users_data)
+            db.commit()
+            insert_elapsed += time.perf_counter() - insert_started
+
+            created_count += len(users_data)
+            failed_count += len(duplicates)
+            row_count += len(users_data)
+            if not INLINE_STORAGE:
+                row_count += sum(1 for user_data in users_data for field in NESTED_FIELDS if user_data.get(field))
+            print(f"Created {created_count} users ({created_count / (time.perf_counter() - started):.0f} users/s)...")
+
+        elapsed = time.perf_counter() - started
         print(f"\nGeneration complete!")
         print(f"   Successfully created: {created_count} users")
         print(f"   Failed: {failed_count} users")
-        print(f"   Total database records: {created_count}")
+        print(f"   Total database records: {row_count}")
+        print(f"   Took {elapsed:.1f}s: {created_count / elapsed:.0f} users/s, {row_count / elapsed:.0f} rows/s")
+        print(f"   Inserts alone: {insert_elapsed:.1f}s, {row_count / max(insert_elapsed, 1e-9):.0f} rows/s")
 
     except Exception as e:
+        db.rollback()
         print(f"Error during user generation: {str(e)}")
+        raise
     finally:
         db.close()
+
+    return created_count
@@ -0,0 +1,122 @@
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency, until the response is fully sent", ["method", "route"]
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled", ["method"])
+
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Database statement execution time", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+
+JOB_DURATION = Histogram(
+    "job_duration_seconds", "Background job duration", ["job"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+JOB_USERS = Counter("job_users_total", "Users created or deleted by background jobs", ["job", "operation"])
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request counts, latency and in-flight requests.
+
+    Requests are labelled by route template (e.g. /v1/users/{user_id}), read from the scope
+    once the router has matched it, so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_flight.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            REQUEST_LATENCY.labels(method, route_path).observe(elapsed)
+            REQUESTS.labels(method, route_path, str(status_code)).inc()
+
+
+def instrument_engine(engine):
+    """Time every statement executed through `engine`, labelled by its verb (SELECT, INSERT, ...)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERY_DURATION.labels(statement.lstrip().split(" ", 1)[0].upper()).observe(elapsed)
+
+
+class CacheCollector:
+    """Expose the counters of an LRUCache, read at scrape time"""
+
+    def __init__(self, name: str, cache):
+        self.name = name
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        for counter in ("hits", "misses"):
+            family = CounterMetricFamily(f"cache_{counter}", f"Cache {counter}", labels=["cache"])
+            family.add_metric([self.name], stats[counter])
+            yield family
+        for gauge in ("size", "hit_ratio"):
+            family = GaugeMetricFamily(f"cache_{gauge}", f"Cache {gauge.replace('_', ' ')}", labels=["cache"])
+            family.add_metric([self.name], stats[gauge])
+            yield family
+
+
+def register_cache(name: str, cache):
+    REGISTRY.register(CacheCollector(name, cache))
+
+
+class BroadcasterCollector:
+    """Expose the subscribers and counters of an EventBroadcaster, read at scrape time"""
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+
+    def collect(self):
+        stats = self.broadcaster.stats()
+        yield GaugeMetricFamily("event_subscribers", "Subscribers of GET /v1/users/events", stats["subscribers"])
+        yield CounterMetricFamily("events_published", "Events published to the subscribers", stats["published"])
+        yield CounterMetricFamily(
+            "event_subscribers_dropped", "Subscribers dropped for falling behind", stats["dropped"]
+        )
+
+
+def register_broadcaster(broadcaster):
+    REGISTRY.register(BroadcasterCollector(broadcaster))
+
+
+def render_metrics() -> bytes:
+    return generate_latest(REGISTRY)
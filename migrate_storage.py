@@ -0,0 +1,21 @@
+"""
+Migrate an existing database between the user storage layouts (USER_STORAGE in models.py).
+
+    python migrate_storage.py inline    # addresses/credit_cards tables -> columns of users
+    python migrate_storage.py tables    # columns of users -> addresses/credit_cards tables
+
+The database is taken from DATABASE_URL. Don't run it against a database the service is using:
+the service reads and writes the layout of its own USER_STORAGE.
+"""
+import sys
+import time
+
+from models import migrate_user_storage
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("inline", "tables"):
+        raise SystemExit(__doc__)
+
+    started = time.perf_counter()
+    migrate_user_storage(sys.argv[1])
+    print(f"Migration to {sys.argv[1]} storage completed in {time.perf_counter() - started:.1f}s")
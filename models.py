@@ -1,22 +1,19 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import event, delete, Column, Date, Integer, String, Float, DateTime, Text, DDL, Index, table, column
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import datetime
-import logging
+import os
 
-DATABASE_URL = "sqlite:///./users.db"
+from database import engine
 
-logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
-
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False
-)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Where addresses and credit cards are stored: "tables" (the addresses and credit_cards tables)
+# or "inline" (columns of the users row, so a user is read and written as one row)
+USER_STORAGE = os.getenv('USER_STORAGE', 'tables')
+if USER_STORAGE not in ("tables", "inline"):
+    raise ValueError(f"USER_STORAGE must be 'tables' or 'inline', got {USER_STORAGE!r}")
+INLINE_STORAGE = USER_STORAGE == "inline"
+
 class Address(Base):
     __tablename__ = "addresses"
 
@@ -38,6 +35,17 @@ class CreditCard(Base):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # The structured filters of /v1/users/search: each one leads an index, alone or with the
+        # filter it is most often combined with, so no combination scans the table
+        Index("ix_users_gender_date_of_birth", "gender", "date_of_birth"),
+        Index("ix_users_gender_salary", "gender", "salary"),
+        Index("ix_users_company_salary", "company", "salary"),
+        Index("ix_users_date_of_birth", "date_of_birth"),
+        Index("ix_users_salary", "salary"),
+        # Ids are never reused, and can be made to start above a range (see virtual_users.py)
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False)
@@ -45,14 +53,214 @@ class User(Base):
     email = Column(String(255), unique=True, nullable=False)
     phone = Column(String(20), nullable=True)
     gender = Column(String(10), nullable=True)
-    date_of_birth = Column(String(20), nullable=True)
+    date_of_birth = Column(Date, nullable=True)
     company = Column(String(200), nullable=True)
     salary = Column(Float, nullable=True)
     about_me = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    # Bumped on every change of the user or its address/credit card, backs the ETags
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+
+    # Address and credit card of USER_STORAGE=inline, NULL with the "tables" storage
+    address_country = Column(String(100), nullable=True)
+    address_city = Column(String(100), nullable=True)
+    address_street = Column(String(200), nullable=True)
+    address_flat_house = Column(String(50), nullable=True)
+    credit_card_num = Column(String(19), nullable=True)
+    credit_card_cvv = Column(String(4), nullable=True)
+    credit_card_exp_date = Column(String(7), nullable=True)
+
+
+# Nested user fields -> (their model with the "tables" storage, their columns). With the inline
+# storage `column` is stored in users.<field>_<column>; the first column is NULL iff the field is.
+NESTED_FIELDS = {
+    "address": (Address, ("country", "city", "street", "flat_house")),
+    "credit_card": (CreditCard, ("num", "cvv", "exp_date")),
+}
+
+
+# Trigram FTS5 index over the searchable text columns of users. It is an external content
+# table (no copy of the data), kept in sync with users by triggers, so every write path is
+# covered without changes. The trigram tokenizer keeps substring (LIKE '%x%') semantics.
+users_fts = table("users_fts", column("rowid"), column("rank"))
+
+USERS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE users_fts USING fts5("
+    "name, surname, email, content='users', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, name, surname, email) VALUES (new.id, new.name, new.surname, new.email); "
+    "END",
+    "CREATE TRIGGER users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, name, surname, email) "
+    "VALUES ('delete', old.id, old.name, old.surname, old.email); "
+    "END",
+    "CREATE TRIGGER users_fts_au AFTER UPDATE OF name, surname, email ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, name, surname, email) "
+    "VALUES ('delete', old.id, old.name, old.surname, old.email); "
+    "INSERT INTO users_fts(rowid, name, surname, email) VALUES (new.id, new.name, new.surname, new.email); "
+    "END",
+]
+
+for statement in USERS_FTS_DDL:
+    event.listen(User.__table__, "after_create", DDL(statement))
+event.listen(User.__table__, "before_drop", DDL("DROP TABLE IF EXISTS users_fts"))
+
+
+class UserTombstone(Base):
+    """Deleted users of the virtual backend (USER_BACKEND=virtual), which have no row to delete"""
+    __tablename__ = "user_tombstones"
+
+    user_id = Column(Integer, primary_key=True)
+
+
+class UserStats(Base):
+    """Single-row table of user counters, maintained by triggers"""
+    __tablename__ = "user_stats"
+
+    id = Column(Integer, primary_key=True)
+    total_users = Column(Integer, nullable=False, default=0)
+    users_with_address = Column(Integer, nullable=False, default=0)
+    users_with_credit_card = Column(Integer, nullable=False, default=0)
+    # With the virtual backend: USERS_NUMBER, and how many of those users are neither stored nor deleted
+    virtual_users = Column(Integer, nullable=False, default=0)
+    unstored_virtual_users = Column(Integer, nullable=False, default=0)
+
+
+USER_STATS_ID = 1
+
+# The counters are updated by triggers in the same transaction as the write that changes them,
+# so they are always exact and reading them never scans. A user is counted as having an
+# address (credit card) when the first one is inserted and uncounted when the last one is deleted,
+# or, with the inline storage, while the inline columns are set. A virtual user stops being
+# unstored when it is stored (ids up to virtual_users) or tombstoned without a stored row.
+USER_STATS_DDL = [
+    f"INSERT INTO user_stats "
+    f"(id, total_users, users_with_address, users_with_credit_card, virtual_users, unstored_virtual_users) "
+    f"VALUES ({USER_STATS_ID}, 0, 0, 0, 0, 0)",
+    "CREATE TRIGGER user_stats_users_ai AFTER INSERT ON users BEGIN "
+    "UPDATE user_stats SET total_users = total_users + 1, "
+    "users_with_address = users_with_address + (new.address_country IS NOT NULL), "
+    "users_with_credit_card = users_with_credit_card + (new.credit_card_num IS NOT NULL), "
+    "unstored_virtual_users = unstored_virtual_users - (new.id <= virtual_users); "
+    "END",
+    "CREATE TRIGGER user_stats_users_ad AFTER DELETE ON users BEGIN "
+    "UPDATE user_stats SET total_users = total_users - 1, "
+    "users_with_address = users_with_address - (old.address_country IS NOT NULL), "
+    "users_with_credit_card = users_with_credit_card - (old.credit_card_num IS NOT NULL); "
+    "END",
+    "CREATE TRIGGER user_stats_users_au AFTER UPDATE OF address_country, credit_card_num ON users BEGIN "
+    "UPDATE user_stats SET "
+    "users_with_address = users_with_address "
+    "+ (new.address_country IS NOT NULL) - (old.address_country IS NOT NULL), "
+    "users_with_credit_card = users_with_credit_card "
+    "+ (new.credit_card_num IS NOT NULL) - (old.credit_card_num IS NOT NULL); "
+    "END",
+    "CREATE TRIGGER user_stats_user_tombstones_ai AFTER INSERT ON user_tombstones "
+    "WHEN NOT EXISTS (SELECT 1 FROM users WHERE id = new.user_id) BEGIN "
+    "UPDATE user_stats SET unstored_virtual_users = unstored_virtual_users - 1; "
+    "END",
+]
+
+for table_name, counter in (("addresses", "users_with_address"), ("credit_cards", "users_with_credit_card")):
+    USER_STATS_DDL += [
+        f"CREATE TRIGGER user_stats_{table_name}_ai AFTER INSERT ON {table_name} "
+        f"WHEN NOT EXISTS (SELECT 1 FROM {table_name} WHERE user_id = new.user_id AND id != new.id) BEGIN "
+        f"UPDATE user_stats SET {counter} = {counter} + 1; "
+        f"END",
+        f"CREATE TRIGGER user_stats_{table_name}_ad AFTER DELETE ON {table_name} "
+        f"WHEN NOT EXISTS (SELECT 1 FROM {table_name} WHERE user_id = old.user_id) BEGIN "
+        f"UPDATE user_stats SET {counter} = {counter} - 1; "
+        f"END",
+    ]
+
+# Registered on the metadata so they run once every table exists
+for statement in USER_STATS_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement))
+
+
+class UserChange(Base):
+    """Append-only log of user writes, read by GET /v1/users/changes"""
+    __tablename__ = "user_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    operation = Column(String(10), nullable=False)
+    changed_at = Column(DateTime, nullable=False, index=True)
+
+
+# Like the counters, the log is written by triggers in the transaction of the write. AUTOINCREMENT
+# keeps seq increasing after old changes are compacted away. Every API update bumps updated_at,
+# while rewrites that don't change the API representation (migrate_user_storage) don't.
+# A tombstone is a delete of a virtual user only when there is no stored row to delete as well.
+USER_CHANGES_DDL = [
+    "CREATE TRIGGER user_changes_users_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO user_changes (user_id, operation, changed_at) VALUES (new.id, 'create', datetime('now')); "
+    "END",
+    "CREATE TRIGGER user_changes_users_au AFTER UPDATE OF updated_at ON users BEGIN "
+    "INSERT INTO user_changes (user_id, operation, changed_at) VALUES (new.id, 'update', datetime('now')); "
+    "END",
+    "CREATE TRIGGER user_changes_users_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO user_changes (user_id, operation, changed_at) VALUES (old.id, 'delete', datetime('now')); "
+    "END",
+    "CREATE TRIGGER user_changes_user_tombstones_ai AFTER INSERT ON user_tombstones "
+    "WHEN NOT EXISTS (SELECT 1 FROM users WHERE id = new.user_id) BEGIN "
+    "INSERT INTO user_changes (user_id, operation, changed_at) VALUES (new.user_id, 'delete', datetime('now')); "
+    "END",
+]
+
+for statement in USER_CHANGES_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement))
+
+
+def reset_user_changes(bind=engine):
+    """Empty the change log after seeding: the seeded users are the baseline it starts from"""
+    with bind.begin() as connection:
+        connection.execute(delete(UserChange))
+
+
+def compact_user_changes(older_than: datetime.datetime, bind=engine) -> int:
+    """Delete the changes made before `older_than`, return how many"""
+    with bind.begin() as connection:
+        return connection.execute(delete(UserChange).where(UserChange.changed_at < older_than)).rowcount
+
+
+def init_db(bind=engine):
+    """Recreate all tables"""
+    print("Creating database tables...")
+    Base.metadata.drop_all(bind=bind)
+    Base.metadata.create_all(bind=bind)
+    print("Database tables created successfully!")
 
+def migrate_user_storage(storage: str, bind=engine):
+    """
+    Move every address and credit card to `storage` ("inline" or "tables"), in one transaction.
 
-print("Creating database tables...")
-Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
-print("Database tables created successfully!")
\ No newline at end of file
+    To inline storage, the first address and card of each user (the ones the API exposes) are
+    copied onto the users row and the addresses and credit_cards tables are emptied. Back to
+    tables storage, the inline columns become rows again and are cleared. updated_at is left
+    alone: the API representation of a user doesn't change.
+    """
+    with bind.begin() as connection:
+        for field, (model, columns) in NESTED_FIELDS.items():
+            table_name = model.__tablename__
+            inline_columns = [f"{field}_{column}" for column in columns]
+            if storage == "inline":
+                assignments = ", ".join(f"{inline} = source.{column}" for inline, column in zip(inline_columns, columns))
+                connection.exec_driver_sql(
+                    f"UPDATE users SET {assignments} FROM ("
+                    f"SELECT user_id, {', '.join(columns)}, "
+                    f"row_number() OVER (PARTITION BY user_id ORDER BY id) AS position FROM {table_name}"
+                    f") AS source WHERE source.user_id = users.id AND source.position = 1"
+                )
+                moved = connection.exec_driver_sql(f"DELETE FROM {table_name}").rowcount
+            else:
+                moved = connection.exec_driver_sql(
+                    f"INSERT INTO {table_name} (user_id, {', '.join(columns)}) "
+                    f"SELECT id, {', '.join(inline_columns)} FROM users WHERE {inline_columns[0]} IS NOT NULL"
+                ).rowcount
+                connection.exec_driver_sql(
+                    f"UPDATE users SET {', '.join(f'{inline} = NULL' for inline in inline_columns)} "
+                    f"WHERE {inline_columns[0]} IS NOT NULL"
+                )
+            print(f"Moved {moved} {table_name} rows to {storage} storage")
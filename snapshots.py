@@ -0,0 +1,131 @@
+"""
+Seeded database snapshots: a (seed, count) dataset is generated once and then restored at
+startup in about the time of a file copy.
+
+A snapshot is a complete SQLite database in SNAPSHOT_DIR, named after its user count, seed,
+storage layout and schema, so a snapshot of another dataset or an older schema is never
+restored. Build one offline (e.g. into a volume or while building the image) with
+
+    SNAPSHOT_DIR=./snapshots python snapshots.py build --users 1000000 --seed 42
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from database import engine
+from generate_users import generate_test_users
+from models import Base, USER_CHANGES_DDL, USER_STATS_DDL, USER_STORAGE, USERS_FTS_DDL, init_db, reset_user_changes
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '')
+
+
+def schema_version() -> str:
+    """Digest of the database DDL"""
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        statements.append(str(CreateTable(table).compile(engine)))
+        statements += sorted(str(CreateIndex(index).compile(engine)) for index in table.indexes)
+    statements += USERS_FTS_DDL + USER_STATS_DDL + USER_CHANGES_DDL
+    return hashlib.sha1("\n".join(statements).encode()).hexdigest()[:12]
+
+
+def snapshot_path(count: int, seed: int, directory: str = SNAPSHOT_DIR) -> str:
+    return os.path.join(directory, f"users-{count}-{seed}-{USER_STORAGE}-{schema_version()}.db")
+
+
+def snapshots_enabled(seed) -> bool:
+    """Snapshots need a directory, a fixed seed (else every start is a new dataset) and SQLite"""
+    return bool(SNAPSHOT_DIR) and seed is not None and engine.url.get_backend_name() == "sqlite"
+
+
+def build_snapshot(count: int, seed: int, directory: str = SNAPSHOT_DIR) -> str:
+    """Generate the (seed, count) dataset into a new snapshot, return its path"""
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(count, seed, directory)
+    # Built under another name and renamed when complete, so a partial snapshot is never restored
+    build_path = f"{path}.building"
+    if os.path.exists(build_path):
+        os.remove(build_path)
+
+    build_engine = create_engine(f"sqlite:///{build_path}")
+    try:
+        init_db(bind=build_engine)
+        generate_test_users(count, seed=seed, bind=build_engine)
+        reset_user_changes(bind=build_engine)
+    finally:
+        build_engine.dispose()
+
+    os.replace(build_path, path)
+    return path
+
+
+def save_snapshot(count: int, seed) -> bool:
+    """Snapshot the service database as the (seed, count) dataset, unless there already is one"""
+    if not snapshots_enabled(seed):
+        return False
+    path = snapshot_path(count, seed)
+    if os.path.exists(path):
+        return False
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    build_path = f"{path}.building"
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        # A consistent, compacted copy taken in a read transaction, writers aren't blocked
+        connection.exec_driver_sql("VACUUM INTO ?", (build_path,))
+    os.replace(build_path, path)
+    logger.info(f"Saved snapshot {path} in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+def restore_snapshot(count: int, seed) -> bool:
+    """
+    Replace the service database with the (seed, count) snapshot, return False if there is none.
+
+    The copy goes through the SQLite backup API, which is safe with the service's WAL
+    database and pooled connections, unlike copying over the database file.
+    """
+    if not snapshots_enabled(seed):
+        return False
+    path = snapshot_path(count, seed)
+    if not os.path.exists(path):
+        logger.info(f"No snapshot of {count} users with seed {seed} in {SNAPSHOT_DIR}")
+        return False
+
+    started = time.perf_counter()
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    target = engine.raw_connection()
+    try:
+        source.backup(target.driver_connection)
+    finally:
+        target.close()
+        source.close()
+    logger.info(f"Restored snapshot {path} in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="generate a snapshot")
+    build_parser.add_argument("--users", type=int, default=int(os.getenv('USERS_NUMBER', 1000)))
+    build_parser.add_argument("--seed", type=int, default=os.getenv('USERS_SEED') or None)
+    args = parser.parse_args()
+
+    if not SNAPSHOT_DIR:
+        raise SystemExit("Set SNAPSHOT_DIR to the directory of the snapshots")
+    if args.seed is None:
+        raise SystemExit("A snapshot needs a seed: pass --seed or set USERS_SEED")
+    started = time.perf_counter()
+    snapshot = build_snapshot(args.users, args.seed)
+    print(f"Snapshot {snapshot} built in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,56 @@
+"""
+The tests run the app in-process against a throw-away SQLite database.
+
+database.py reads DATABASE_URL when it is imported, so it is set here, before any test
+module imports the app. The app's lifespan (seeding, jobs) doesn't run: tests seed the
+database themselves with `seed_users`.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+DATABASE_DIRECTORY = tempfile.mkdtemp(prefix="user-service-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(DATABASE_DIRECTORY, 'users.db')}"
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import app, user_cache  # noqa: E402
+from database import engine  # noqa: E402
+from generate_users import generate_test_users  # noqa: E402
+from models import init_db  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    engine.dispose()
+    shutil.rmtree(DATABASE_DIRECTORY, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture(scope="session")
+def seed_users():
+    """Recreate the database with `count` generated users (the same ones for the same count)"""
+    def seed(count: int):
+        init_db()
+        generate_test_users(count, seed=42, workers=1)
+        user_cache.clear()
+    return seed
+
+
+@pytest.fixture
+def statements():
+    """The (statement, parameters) of every statement executed while the test runs"""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
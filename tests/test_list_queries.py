@@ -0,0 +1,30 @@
+"""List endpoints read users with a fixed number of statements, whatever the number of users"""
+import pytest
+
+SMALL_DATASET = 20
+LARGE_DATASET = 400
+
+LIST_REQUESTS = [
+    ("/v1/users", {}),
+    ("/v1/users", {"limit": 50}),
+    ("/v1/users", {"fields": "name,address"}),
+    ("/v1/users/search", {"name": "a"}),
+    ("/v1/users/search", {"surname": "son"}),
+    ("/v1/users/search", {"gender": "female", "limit": 50}),
+]
+
+
+@pytest.mark.parametrize("path, params", LIST_REQUESTS)
+def test_query_count_does_not_grow_with_users(client, seed_users, statements, path, params):
+    query_counts = []
+    user_counts = []
+    for count in (SMALL_DATASET, LARGE_DATASET):
+        seed_users(count)
+        statements.clear()
+        response = client.get(path, params=params)
+        assert response.status_code == 200
+        query_counts.append(len(statements))
+        user_counts.append(len(response.json()))
+
+    assert user_counts[0] < user_counts[1]
+    assert query_counts[0] == query_counts[1]
@@ -0,0 +1,32 @@
+"""Malformed query parameters are answered with 400, never with a server error"""
+import base64
+import json
+
+import pytest
+
+
+def cursor_of(payload: str) -> str:
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+@pytest.fixture(scope="module")
+def seeded(seed_users):
+    seed_users(20)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!", cursor_of("[]"), cursor_of('{"id": "x"}'), cursor_of('{"id": 1e999}'),
+    cursor_of(json.dumps({"id": 10 ** 30})), cursor_of(json.dumps({"id": -10 ** 30})),
+])
+@pytest.mark.parametrize("path", ["/v1/users", "/v1/users/search"])
+def test_invalid_cursor(client, seeded, path, cursor):
+    response = client.get(path, params={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+@pytest.mark.parametrize("ids", ["1,x", "99999999999999999999", f"1,{-2 ** 63}"])
+def test_invalid_ids(client, seeded, ids):
+    response = client.get("/v1/users", params={"ids": ids})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "ids must be a comma-separated list of integers"
@@ -0,0 +1,52 @@
+"""No combination of the structured /v1/users/search filters scans the users table"""
+import datetime
+import itertools
+import re
+
+import pytest
+
+from database import engine
+
+USERS = 5000
+FILTERS = {
+    "gender": {"gender": "female"},
+    "company": {"company": "Smith Ltd"},
+    "date_of_birth": {"date_of_birth": datetime.date(1980, 5, 17)},
+    "date_of_birth range": {
+        "date_of_birth_from": datetime.date(1970, 1, 1), "date_of_birth_to": datetime.date(1975, 12, 31)
+    },
+    "date_of_birth_from": {"date_of_birth_from": datetime.date(2000, 1, 1)},
+    "salary range": {"salary_min": 50000, "salary_max": 60000},
+    "salary_min": {"salary_min": 150000},
+}
+PAGINATION = {"all": {}, "page": {"limit": 100}}
+# Plan lines reading every row of users, through the table or a whole index
+FULL_SCAN = re.compile(r"\bSCAN users\b")
+
+
+def filter_combinations():
+    for size in range(1, len(FILTERS) + 1):
+        for names in itertools.combinations(FILTERS, size):
+            yield " + ".join(names), {key: value for name in names for key, value in FILTERS[name].items()}
+
+
+@pytest.fixture(scope="module")
+def seeded(seed_users):
+    seed_users(USERS)
+
+
+@pytest.mark.parametrize("mode", PAGINATION)
+@pytest.mark.parametrize("filters", [filters for _, filters in filter_combinations()],
+                         ids=[name for name, _ in filter_combinations()])
+def test_search_uses_an_index(client, seeded, statements, filters, mode):
+    response = client.get("/v1/users/search", params={**filters, **PAGINATION[mode]})
+    assert response.status_code == 200
+
+    plans = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            if statement.lstrip().upper().startswith("SELECT"):
+                rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                plans.extend(row[-1] for row in rows)
+    assert plans
+    assert not [line for line in plans if FULL_SCAN.search(line)], plans
@@ -0,0 +1,97 @@
+"""Users encoded with orjson are byte for byte what UserResponse validation produces"""
+import datetime
+
+import orjson
+import pytest
+
+from app import (
+    ORJSON_MAX_EXACT_FLOAT, UserResponse, encode_user, encode_users, get_users_with_details, is_trusted_encodable,
+    user_list_adapter
+)
+from database import SessionLocal
+from models import Address, CreditCard, User, init_db
+
+SALARIES = [
+    None, 0.0, 0.1, -2.5, 1e-7, 123456789.123, 1e15 + 0.5, 9999999999999998.0,
+    ORJSON_MAX_EXACT_FLOAT, -ORJSON_MAX_EXACT_FLOAT, 1.5e17, 1e300,
+]
+TEXTS = ["plain", "Ærøskøbing, 東京 😀", 'quote " backslash \\ slash /', "new\nline\ttab \x01 control", ""]
+
+
+def user_rows():
+    """(user, address, credit card) rows covering every null, text and salary case"""
+    rows = []
+    for index, salary in enumerate(SALARIES):
+        text = TEXTS[index % len(TEXTS)]
+        user = User(
+            name=text or "name", surname=f"surname {index}", email=f"user{index}@example.org",
+            phone=None if index % 2 else "+1 555 0100", date_of_birth=None if index % 3 else datetime.date(1990, 2, 28),
+            gender=None if index % 4 else "female", company=text or None, salary=salary, about_me=text,
+            # Whole seconds are written without a fraction, the others with microseconds
+            created_at=datetime.datetime(2024, 1, 2, 3, 4, 5, 0 if index % 2 else 120000),
+        )
+        address = None if index % 2 else Address(country="Україна", city=text, street="Main", flat_house="1")
+        credit_card = None if index % 3 == 1 else CreditCard(num="4111-1111-1111-1111", cvv="123", exp_date="01/2030")
+        rows.append((user, address, credit_card))
+    return rows
+
+
+@pytest.fixture(scope="module")
+def users():
+    init_db()
+    db = SessionLocal()
+    try:
+        for user, address, credit_card in user_rows():
+            db.add(user)
+            db.flush()
+            for details in (address, credit_card):
+                if details is not None:
+                    details.user_id = user.id
+                    db.add(details)
+        db.commit()
+        # Read back as the endpoints do, so the values have the types the database returns
+        return get_users_with_details(db, db.query(User))
+    finally:
+        db.close()
+
+
+def test_cases_are_covered(users):
+    assert any(user["address"] is None for user in users) and any(user["credit_card"] is None for user in users)
+    assert any(user["created_at"].microsecond == 0 for user in users)
+    assert any(user["created_at"].microsecond != 0 for user in users)
+    assert any(is_trusted_encodable([user]) for user in users)
+    assert any(not is_trusted_encodable([user]) for user in users)
+
+
+def test_user_encoding_matches_user_response(users):
+    for user in users:
+        assert encode_user(user) == UserResponse.model_validate(user).model_dump_json().encode()
+
+
+def test_user_list_encoding_matches_user_response(users):
+    trusted = [user for user in users if is_trusted_encodable([user])]
+    for subset in (users, trusted):
+        assert encode_users(subset) == user_list_adapter.dump_json(user_list_adapter.validate_python(subset))
+
+
+@pytest.mark.parametrize(
+    "salary", [ORJSON_MAX_EXACT_FLOAT / 10, ORJSON_MAX_EXACT_FLOAT - 2, -(ORJSON_MAX_EXACT_FLOAT - 2)]
+)
+def test_orjson_matches_pydantic_below_threshold(users, salary):
+    """Below ORJSON_MAX_EXACT_FLOAT the user is encoded with orjson alone, which must agree with pydantic"""
+    user = dict(users[0], salary=salary)
+    assert is_trusted_encodable([user])
+    assert orjson.dumps(user) == UserResponse.model_validate(user).model_dump_json().encode()
+
+
+@pytest.mark.parametrize("fields", [["id", "salary"], ["id", "name", "salary", "created_at"], ["id", "address"]])
+def test_projection_encoding_matches_user_response(users, fields):
+    """A field is written the same whether it is projected or not"""
+    projected = [{field: user[field] for field in fields} for user in users]
+    for user, projection in zip(users, projected):
+        expected = UserResponse.model_validate(user).model_dump_json(include=set(fields)).encode()
+        assert encode_user(projection, fields) == expected
+    expected = b"[" + b",".join(
+        UserResponse.model_validate(user).model_dump_json(include=set(fields)).encode() for user in users
+    ) + b"]"
+    assert encode_users(projected, fields) == expected
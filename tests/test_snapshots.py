@@ -0,0 +1,21 @@
+"""A snapshot is only saved for a completely generated dataset"""
+import os
+
+import pytest
+
+import generate_users
+from snapshots import build_snapshot, snapshot_path
+
+
+def test_failed_generation_leaves_no_snapshot(tmp_path, monkeypatch):
+    def failing_insert(db, users_data):
+        raise RuntimeError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(generate_users, "bulk_insert_users", failing_insert)
+        with pytest.raises(RuntimeError):
+            build_snapshot(30, 7, str(tmp_path))
+    assert not os.path.exists(snapshot_path(30, 7, str(tmp_path)))
+
+    assert build_snapshot(30, 7, str(tmp_path)) == snapshot_path(30, 7, str(tmp_path))
+    assert os.path.exists(snapshot_path(30, 7, str(tmp_path)))
@@ -0,0 +1,27 @@
+"""GET /v1/users/changes never hands out a next_since below a change it returned"""
+import app as app_module
+from database import SessionLocal
+from models import User
+
+
+def test_next_since_covers_changes_committed_after_the_bounds(client, seed_users, monkeypatch):
+    seed_users(20)
+    since = client.get("/v1/users/changes").json()["next_since"]
+    read_bounds = app_module.get_change_log_bounds
+
+    def bounds_then_write(db):
+        bounds = read_bounds(db)
+        # Committed by another session between reading the bounds and the changes
+        writer = SessionLocal()
+        try:
+            writer.get(User, 1).name = "Changed"
+            writer.commit()
+        finally:
+            writer.close()
+        return bounds
+
+    monkeypatch.setattr(app_module, "get_change_log_bounds", bounds_then_write)
+    body = client.get("/v1/users/changes", params={"since": since}).json()
+
+    assert [change["user_id"] for change in body["changes"]] == [1]
+    assert body["next_since"] >= body["changes"][-1]["seq"]
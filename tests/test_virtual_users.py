@@ -0,0 +1,80 @@
+"""Virtual users are found and counted without scanning the tombstones of deleted ones"""
+import random
+
+import pytest
+from sqlalchemy import func, insert, select
+
+from database import SessionLocal
+from models import USER_STATS_ID, User, UserStats, UserTombstone, init_db
+from virtual_users import (
+    VIRTUAL_USERS_NUMBER, delete_virtual_users, find_virtual_emails, generate_virtual_user, init_virtual_users,
+    materialize_virtual_user, virtual_ids_after
+)
+
+
+@pytest.fixture
+def db():
+    init_db()
+    session = SessionLocal()
+    try:
+        init_virtual_users(session)
+        session.commit()
+        yield session
+    finally:
+        session.close()
+
+
+def tombstone(db, user_ids):
+    db.execute(insert(UserTombstone), [{"user_id": user_id} for user_id in user_ids])
+    db.commit()
+
+
+def test_ids_after_skip_tombstones(db):
+    rng = random.Random(1)
+    # A leading run, as left by the churn job, then scattered deletes and the last id
+    deleted = set(range(1, 301)) | set(rng.sample(range(301, VIRTUAL_USERS_NUMBER), 300)) | {VIRTUAL_USERS_NUMBER}
+    tombstone(db, sorted(deleted))
+    live = [user_id for user_id in range(1, VIRTUAL_USERS_NUMBER + 1) if user_id not in deleted]
+
+    for after_id in (0, 1, 150, 300, 301, 500, VIRTUAL_USERS_NUMBER - 5, VIRTUAL_USERS_NUMBER):
+        for limit in (1, 3, 101, VIRTUAL_USERS_NUMBER):
+            expected = [user_id for user_id in live if user_id > after_id][:limit]
+            assert virtual_ids_after(db, after_id, limit) == expected
+
+
+def test_ids_after_are_one_statement(db, statements):
+    tombstone(db, range(1, VIRTUAL_USERS_NUMBER - 10))
+    statements.clear()
+    assert virtual_ids_after(db, 0, 3) == [VIRTUAL_USERS_NUMBER - 10 + offset for offset in range(3)]
+    assert len(statements) == 1
+
+
+def test_unstored_virtual_users_are_counted(db):
+    materialize_virtual_user(db, 5)
+    materialize_virtual_user(db, 6)
+    db.commit()
+    # Deleting a stored virtual user tombstones it and deletes its row
+    delete_virtual_users(db, [6, 7, 8])
+    db.query(User).filter(User.id == 6).delete()
+    db.commit()
+    db.add(User(name="Created", surname="User", email="created@example.org", about_me="Created"))
+    db.commit()
+
+    stats = db.get(UserStats, USER_STATS_ID, populate_existing=True)
+    deleted_count = db.scalar(select(func.count()).select_from(UserTombstone))
+    stored_count = db.scalar(select(func.count(User.id)).where(User.id <= VIRTUAL_USERS_NUMBER))
+    assert stats.unstored_virtual_users == VIRTUAL_USERS_NUMBER - deleted_count - stored_count
+    assert stats.unstored_virtual_users == VIRTUAL_USERS_NUMBER - 4
+
+
+def test_virtual_emails_are_found_in_bulk(db, statements):
+    materialize_virtual_user(db, 2)
+    db.commit()
+    tombstone(db, [3])
+    emails = [generate_virtual_user(user_id)["email"] for user_id in range(1, 51)]
+    emails += ["someone.else10@example.org", "no.digits@example.org", f"too.high{VIRTUAL_USERS_NUMBER + 1}@example.org"]
+
+    statements.clear()
+    found = find_virtual_emails(db, emails)
+    assert found == {emails[user_id - 1]: user_id for user_id in range(1, 51) if user_id not in (2, 3)}
+    assert len(statements) == 2
@@ -0,0 +1,157 @@
+"""
+Incremental parsing of the bodies of POST /v1/users/import, as NDJSON or CSV.
+
+The body is an iterator of byte chunks, split into lines as they arrive, so only the current
+line is held however large the file is. Rows come out as (line, data, error): the line of the
+body the row starts on, then either the user data to validate (a dict shaped like the JSON
+body of POST /v1/users) or why the row can't be read.
+"""
+import csv
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import orjson
+
+from generate_users import USER_FIELDS
+from models import NESTED_FIELDS
+
+ImportRow = Tuple[int, Optional[dict], Optional[str]]
+
+
+class ImportFormatError(ValueError):
+    """The body can't be imported at all, e.g. a CSV header with unknown columns"""
+
+
+def iter_lines(chunks: Iterable[bytes], max_line_bytes: int) -> Iterator[Tuple[Optional[str], Optional[str]]]:
+    """
+    Split `chunks` into lines without their line endings, yielding (text, None) per line, or
+    (None, error) for a line longer than `max_line_bytes` (skipped without being buffered) or not UTF-8.
+    """
+    buffer = b""
+    too_long = False
+    first = True
+
+    def decode(line: bytes):
+        nonlocal first, too_long
+        if too_long:
+            too_long = False
+            return None, f"Line is longer than {max_line_bytes} bytes"
+        try:
+            # A byte order mark can only start the body
+            text = line.decode("utf-8-sig" if first else "utf-8")
+        except UnicodeDecodeError:
+            return None, "Line is not valid UTF-8"
+        finally:
+            first = False
+        return text.removesuffix("\r"), None
+
+    for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield decode(line)
+        if too_long or len(buffer) > max_line_bytes:
+            too_long = True
+            buffer = b""
+    if buffer or too_long:
+        yield decode(buffer)
+
+
+def parse_ndjson(chunks: Iterable[bytes], max_line_bytes: int) -> Iterator[ImportRow]:
+    """One JSON object per line, blank lines are skipped"""
+    for line, (text, error) in enumerate(iter_lines(chunks, max_line_bytes), start=1):
+        if error is not None:
+            yield line, None, error
+            continue
+        if not text.strip():
+            continue
+        try:
+            data = orjson.loads(text)
+        except orjson.JSONDecodeError as decode_error:
+            yield line, None, f"Invalid JSON: {decode_error}"
+            continue
+        if not isinstance(data, dict):
+            yield line, None, "Expected a JSON object"
+            continue
+        yield line, data, None
+
+
+def parse_csv_header(header: List[str], required_columns: Iterable[str]) -> List[Tuple[str, Optional[str]]]:
+    """
+    The (field, nested column) of each CSV column: user fields are named as in JSON, address and
+    credit card columns as in the inline storage layout (`address_city`, `credit_card_num`, ...).
+    """
+    nested_columns = {
+        f"{field}_{column}": (field, column) for field, (_, columns) in NESTED_FIELDS.items() for column in columns
+    }
+    names = [name.strip() for name in header]
+    unknown = [name for name in names if name not in USER_FIELDS and name not in nested_columns]
+    if unknown:
+        raise ImportFormatError(f"Unknown CSV columns: {', '.join(unknown)}")
+    repeated = sorted({name for name in names if names.count(name) > 1})
+    if repeated:
+        raise ImportFormatError(f"Repeated CSV columns: {', '.join(repeated)}")
+    missing = [name for name in required_columns if name not in names]
+    if missing:
+        raise ImportFormatError(f"Missing CSV columns: {', '.join(missing)}")
+    return [nested_columns.get(name, (name, None)) for name in names]
+
+
+def parse_csv(chunks: Iterable[bytes], max_line_bytes: int,
+              required_columns: Iterable[str] = ()) -> Iterator[ImportRow]:
+    """
+    A header row naming the columns (see `parse_csv_header`), then one user per row. Empty values
+    are left out, and an address or credit card with no value at all is omitted.
+    """
+    skipped = []
+
+    def lines():
+        for line, (text, error) in enumerate(iter_lines(chunks, max_line_bytes), start=1):
+            if error is not None:
+                skipped.append((line, error))
+                # Read as an empty row, which is ignored
+                text = ""
+            yield text + "\n"
+
+    reader = csv.reader(lines())
+    try:
+        header = next(reader)
+    except StopIteration:
+        return
+    except csv.Error as error:
+        raise ImportFormatError(f"Invalid CSV header: {error}")
+    if skipped:
+        raise ImportFormatError(f"Invalid CSV header: {skipped[0][1]}")
+    columns = parse_csv_header(header, required_columns)
+
+    while True:
+        start = reader.line_num + 1
+        error = None
+        try:
+            record = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as csv_error:
+            record, error = None, f"Invalid CSV: {csv_error}"
+        # Lines skipped while reading the row are reported first
+        for line, skip_error in skipped:
+            yield line, None, skip_error
+        skipped.clear()
+        if error is not None:
+            yield start, None, error
+            continue
+        if not record:
+            continue
+        if len(record) != len(columns):
+            yield start, None, f"Expected {len(columns)} values, got {len(record)}"
+            continue
+        data = {}
+        for (field, column), value in zip(columns, record):
+            if value == "":
+                continue
+            if column is None:
+                data[field] = value
+            else:
+                data.setdefault(field, {})[column] = value
+        yield start, data, None
+    for line, skip_error in skipped:
+        yield line, None, skip_error
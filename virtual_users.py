@@ -0,0 +1,206 @@
+"""
+Virtual user backend (USER_BACKEND=virtual) for datasets too large to store.
+
+User N (1 <= N <= USERS_NUMBER) is generated on demand from (USERS_SEED, N) by the generators
+of generate_users.py, so reading any user costs the same and nothing is kept in memory. The
+database is only an overlay of the changes: users created through the API get ids above
+USERS_NUMBER, a virtual user is stored (materialized) when it is first updated, and deleted
+virtual users get a tombstone.
+"""
+import datetime
+import logging
+import os
+import random
+import threading
+from typing import Dict, List
+
+from faker import Faker
+from sqlalchemy import insert, select, text
+from sqlalchemy.orm import Session
+
+from generate_users import USER_FIELDS, generate_user_data
+from models import INLINE_STORAGE, NESTED_FIELDS, USER_STATS_ID, User, UserTombstone
+
+logger = logging.getLogger(__name__)
+
+USER_BACKEND = os.getenv('USER_BACKEND', 'database')
+if USER_BACKEND not in ("database", "virtual"):
+    raise ValueError(f"USER_BACKEND must be 'database' or 'virtual', got {USER_BACKEND!r}")
+VIRTUAL_BACKEND = USER_BACKEND == "virtual"
+
+VIRTUAL_USERS_NUMBER = int(os.getenv('USERS_NUMBER', 1000))
+VIRTUAL_SEED = int(os.getenv('USERS_SEED')) if os.getenv('USERS_SEED') else None
+# Every worker and restart must generate the same user for an id, which its ETag is derived from
+if VIRTUAL_BACKEND and VIRTUAL_SEED is None:
+    raise ValueError("USER_BACKEND=virtual needs USERS_SEED")
+# Virtual user N is created N seconds after this, so older users have smaller ids as with stored ones
+VIRTUAL_EPOCH = datetime.datetime(2020, 1, 1)
+
+# Faker instances are reseeded per user, so each handler thread has its own
+thread_generators = threading.local()
+
+
+def init_virtual_users(db: Session):
+    """
+    Make the ids of users created through the API start above the virtual ones and start counting
+    the unstored virtual users in user_stats (see USER_STATS_DDL). The caller commits.
+    """
+    db.execute(text("DELETE FROM sqlite_sequence WHERE name = 'users'"))
+    db.execute(
+        text(
+            "INSERT INTO sqlite_sequence (name, seq) "
+            "VALUES ('users', max(:seq, (SELECT coalesce(max(id), 0) FROM users)))"
+        ),
+        {"seq": VIRTUAL_USERS_NUMBER}
+    )
+    db.execute(
+        text(
+            "UPDATE user_stats SET virtual_users = :count, unstored_virtual_users = :count "
+            "- (SELECT count(*) FROM user_tombstones) - (SELECT count(*) FROM users WHERE id <= :count) "
+            "WHERE id = :stats_id"
+        ),
+        {"count": VIRTUAL_USERS_NUMBER, "stats_id": USER_STATS_ID}
+    )
+    logger.info(f"Serving {VIRTUAL_USERS_NUMBER} virtual users (seed: {VIRTUAL_SEED})")
+
+
+def is_virtual_id(user_id: int) -> bool:
+    return 1 <= user_id <= VIRTUAL_USERS_NUMBER
+
+
+def virtual_created_at(user_id: int) -> datetime.datetime:
+    return VIRTUAL_EPOCH + datetime.timedelta(seconds=user_id)
+
+
+def generate_virtual_user(user_id: int) -> dict:
+    """
+    Data of virtual user `user_id` as returned by generate_user_data, the same for the same seed.
+
+    The email ends in the user id instead of a random number, so virtual emails are unique.
+    """
+    user_seed = f"{VIRTUAL_SEED}:user:{user_id}"
+    faker = getattr(thread_generators, "faker", None)
+    if faker is None:
+        faker = thread_generators.faker = Faker()
+    faker.seed_instance(user_seed)
+    user_data = generate_user_data(random.Random(user_seed), faker)
+
+    local_part, domain = user_data["email"].split("@")
+    user_data["email"] = f"{local_part.rstrip('0123456789')}{user_id}@{domain}"
+    return user_data
+
+
+def serialize_virtual_user(user_id: int) -> dict:
+    """Virtual user `user_id` in the shape of `serialize_user` in app.py"""
+    user_data = generate_virtual_user(user_id)
+    address_columns = NESTED_FIELDS["address"][1]
+    credit_card_columns = NESTED_FIELDS["credit_card"][1]
+    return {
+        "id": user_id,
+        "name": user_data["name"],
+        "surname": user_data["surname"],
+        "email": user_data["email"],
+        "phone": user_data["phone"],
+        "date_of_birth": user_data["date_of_birth"],
+        "address": {column: user_data["address"][column] for column in address_columns},
+        "gender": user_data["gender"],
+        "company": user_data["company"],
+        "salary": user_data["salary"],
+        "about_me": user_data["about_me"],
+        "credit_card": {column: user_data["credit_card"][column] for column in credit_card_columns},
+        "created_at": virtual_created_at(user_id),
+    }
+
+
+def live_virtual_ids(db: Session, user_ids: List[int]) -> List[int]:
+    """The ids of `user_ids` that are virtual users and weren't deleted"""
+    candidate_ids = [user_id for user_id in user_ids if is_virtual_id(user_id)]
+    if not candidate_ids:
+        return []
+    deleted = set(db.scalars(select(UserTombstone.user_id).where(UserTombstone.user_id.in_(candidate_ids))))
+    return [user_id for user_id in candidate_ids if user_id not in deleted]
+
+
+# Runs of ids without a tombstone from :start on: each starts at :start or right after a tombstone
+# and ends before the next tombstone (NULL: there is none). Every run holds at least one id.
+LIVE_ID_RUNS = text(
+    "SELECT run_start, (SELECT min(user_id) FROM user_tombstones WHERE user_id > run_start) AS run_end "
+    "FROM ("
+    "SELECT :start AS run_start WHERE NOT EXISTS (SELECT 1 FROM user_tombstones WHERE user_id = :start) "
+    "UNION ALL "
+    "SELECT tombstone.user_id + 1 FROM user_tombstones AS tombstone WHERE tombstone.user_id >= :start "
+    "AND NOT EXISTS (SELECT 1 FROM user_tombstones WHERE user_id = tombstone.user_id + 1) "
+    "ORDER BY run_start LIMIT :limit"
+    ")"
+)
+
+
+def virtual_ids_after(db: Session, after_id: int, limit: int) -> List[int]:
+    """
+    The next `limit` ids of virtual users that weren't deleted after `after_id`, in order.
+
+    Read in one statement from the runs of ids between tombstones, so a long run of deleted
+    users (the churn deletes the oldest ones) is skipped by SQLite instead of window by window.
+    """
+    result = []
+    runs = db.execute(LIVE_ID_RUNS, {"start": max(after_id, 0) + 1, "limit": limit})
+    for run_start, run_end in runs:
+        run_end = min(run_end or VIRTUAL_USERS_NUMBER + 1, VIRTUAL_USERS_NUMBER + 1)
+        result.extend(range(run_start, min(run_end, run_start + limit - len(result))))
+        if len(result) >= limit:
+            break
+    return result
+
+
+def find_virtual_emails(db: Session, emails: List[str]) -> Dict[str, int]:
+    """
+    The ids of the unstored virtual users with `emails`, by email (stored users are in the database).
+
+    Generated emails end in the user id, so only the users with those ids that are neither deleted
+    nor stored (one query each for all the emails) are generated to compare their email.
+    """
+    candidates = {}
+    for email in emails:
+        local_part, _, _ = email.rpartition("@")
+        digits = local_part[len(local_part.rstrip("0123456789")):]
+        if digits and is_virtual_id(int(digits)):
+            candidates[email] = int(digits)
+    if not candidates:
+        return {}
+
+    user_ids = set(live_virtual_ids(db, sorted(set(candidates.values()))))
+    if user_ids:
+        user_ids.difference_update(db.scalars(select(User.id).where(User.id.in_(user_ids))))
+    generated = {user_id: generate_virtual_user(user_id)["email"] for user_id in user_ids}
+    return {email: user_id for email, user_id in candidates.items() if generated.get(user_id) == email}
+
+
+def materialize_virtual_user(db: Session, user_id: int) -> User:
+    """Store virtual user `user_id` as it is, so it can be updated. The caller commits."""
+    user_data = generate_virtual_user(user_id)
+    created_at = virtual_created_at(user_id)
+    db_user = User(
+        id=user_id, created_at=created_at, updated_at=created_at, **{field: user_data[field] for field in USER_FIELDS}
+    )
+    if INLINE_STORAGE:
+        for field, (_, columns) in NESTED_FIELDS.items():
+            for column in columns:
+                setattr(db_user, f"{field}_{column}", user_data[field][column])
+    db.add(db_user)
+    db.flush()
+
+    if not INLINE_STORAGE:
+        for field, (model, _) in NESTED_FIELDS.items():
+            db.add(model(user_id=user_id, **user_data[field]))
+        db.flush()
+    return db_user
+
+
+def delete_virtual_users(db: Session, user_ids: List[int]):
+    """
+    Tombstone the virtual users of `user_ids`. The caller then deletes their stored rows, if any,
+    and commits (tombstones come first, so each deleted user is logged once in user_changes).
+    """
+    tombstones = [{"user_id": user_id} for user_id in user_ids if is_virtual_id(user_id)]
+    if tombstones:
+        db.execute(insert(UserTombstone).prefix_with("OR IGNORE"), tombstones)
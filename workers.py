@@ -0,0 +1,99 @@
+"""
+Coordination of the worker processes serving one database (e.g. uvicorn --workers N).
+
+Every worker serves requests, but only the first worker of a deployment initializes the
+database (seeds it or restores a snapshot) and only the leader runs the scheduled jobs. Both
+are decided with flock(2) locks on files next to the database, which the OS releases when the
+process holding them exits or dies:
+
+- `<prefix>.startup.lock`, held exclusively by a starting worker, so startups run one at a time;
+- `<prefix>.workers.lock`, held shared by every running worker. A starting worker that can
+  lock it exclusively is the only one alive: the deployment is new and it initializes;
+- `<prefix>.leader.lock`, held exclusively by the leader. Followers retry it, and the first
+  one to get it after the leader is gone takes over the jobs (without initializing again).
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): every process acts as a single-process deployment
+    fcntl = None
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+
+def default_lock_prefix() -> str:
+    """The SQLite database file, or a temporary path named after the database URL"""
+    database = engine.url.database
+    if engine.url.get_backend_name() == "sqlite" and database and database != ":memory:":
+        return os.path.abspath(database)
+    digest = hashlib.sha1(str(engine.url).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"users-{digest}")
+
+
+WORKER_LOCK_PREFIX = os.getenv('WORKER_LOCK_PREFIX') or default_lock_prefix()
+
+
+class WorkerLocks:
+    """The locks of one worker process, see the module docstring"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.is_leader = False
+        self._files = {}
+
+    def _file(self, name: str):
+        if name not in self._files:
+            self._files[name] = open(f"{self.prefix}.{name}.lock", "a+")
+        return self._files[name]
+
+    def _try_lock(self, name: str, operation: int) -> bool:
+        try:
+            fcntl.flock(self._file(name), operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @contextlib.contextmanager
+    def startup(self):
+        """Hold the startup lock, waiting for the workers starting before this one"""
+        if fcntl is None:
+            yield
+            return
+        startup_file = self._file("startup")
+        fcntl.flock(startup_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(startup_file, fcntl.LOCK_UN)
+
+    def join(self) -> bool:
+        """Register this worker, return True if no other one is running. Call within `startup`."""
+        if fcntl is None:
+            return True
+        alone = self._try_lock("workers", fcntl.LOCK_EX)
+        # Converting the lock isn't atomic, but no other worker can be joining meanwhile
+        fcntl.flock(self._file("workers"), fcntl.LOCK_SH)
+        return alone
+
+    def try_lead(self) -> bool:
+        """Become the leader if there is none, return whether this worker is the leader"""
+        if not self.is_leader:
+            self.is_leader = fcntl is None or self._try_lock("leader", fcntl.LOCK_EX)
+            if self.is_leader:
+                logger.info(f"Worker {os.getpid()} is the leader")
+        return self.is_leader
+
+    def close(self):
+        """Release every lock"""
+        for lock_file in self._files.values():
+            lock_file.close()
+        self._files.clear()
+        self.is_leader = False